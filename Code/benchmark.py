@@ -0,0 +1,223 @@
+"""Offline performance benchmarks on synthetic QuickDraw data.
+
+Writes a dataset of synthetic sketches (see synthetic.py) to a temporary
+directory and times the data pipeline, rasterizing the sketches into
+bitmaps, the SketchRNN training step and evaluation, and the CNN training
+step and evaluation on synthetic bitmaps.
+Every benchmark is repeated and its median, minimum and all timings, in
+seconds per call, are written as JSON. Given a baseline written by an
+earlier run, every benchmark slower by more than the threshold is reported
+and the exit status is 1.
+
+  python benchmark.py --benchmark_output=baseline.json
+  python benchmark.py --benchmark_output=new.json --baseline=baseline.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import model as sketch_rnn_model
+import rasterize
+import sketch_rnn
+import synthetic
+import utils_class as utils
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string(
+    'benchmark_output', 'benchmark.json', 'Where to write the results.')
+tf.app.flags.DEFINE_string(
+    'baseline', '', 'Results of an earlier run to compare against.')
+tf.app.flags.DEFINE_float(
+    'regression_threshold', 0.10,
+    'Relative slowdown of a median over the baseline reported as regression.')
+tf.app.flags.DEFINE_integer(
+    'repeats', 5, 'Number of timed repetitions of every benchmark.')
+tf.app.flags.DEFINE_integer(
+    'sketches_per_class', 2500,
+    'Number of synthetic training sketches per class; valid and test get a '
+    'tenth of that.')
+tf.app.flags.DEFINE_integer('seed', 0, 'Seed of the synthetic data.')
+
+
+def time_calls(fn, repeats, number=1):
+  """Return timing stats in seconds per call of number calls, repeated."""
+  fn()  # warm up
+  times = []
+  for _ in range(repeats):
+    start = time.time()
+    for _ in range(number):
+      fn()
+    times.append((time.time() - start) / number)
+  return {'median': float(np.median(times)), 'min': float(np.min(times)),
+          'times': times}
+
+
+def benchmark_data(results, data_dir, model_params, repeats):
+  """Time loading, preprocessing and batching; return load_dataset's result."""
+  def load():
+    return sketch_rnn.load_dataset(
+        data_dir, sketch_rnn_model.copy_hparams(model_params), cache_dir=None)
+
+  results['load_dataset'] = time_calls(load, repeats)
+  datasets = load()
+  train_set = datasets[0]
+  batch_size = train_set.batch_size
+  batch = [train_set.strokes[i] for i in range(batch_size)]
+  lengths = train_set.strokes.lengths()[:batch_size]
+  points = train_set.points[utils.ragged_index(
+      train_set.offsets[:batch_size], lengths)]
+
+  def augment():
+    # what _get_batch_from_indices runs on every training batch.
+    augmented = points.copy()
+    train_set.random_scale_batch(augmented, lengths)
+    utils.augment_strokes_batch(augmented, lengths,
+                                model_params.augment_stroke_prob)
+
+  def augment_loop():
+    for sketch in batch:
+      utils.augment_strokes(sketch, model_params.augment_stroke_prob)
+
+  results['augment_strokes_batch'] = time_calls(augment, repeats, number=20)
+  # the per-sketch loop training used before, for comparison.
+  results['augment_strokes_loop'] = time_calls(augment_loop, repeats)
+  position = [0]
+
+  def get_batch():
+    train_set.get_batch(position[0] % train_set.num_batches)
+    position[0] += 1
+
+  results['get_batch'] = time_calls(get_batch, repeats, number=20)
+  results['pad_batch'] = time_calls(
+      lambda: train_set.pad_batch(batch, train_set.max_seq_length), repeats,
+      number=20)
+  results['calculate_normalizing_scale_factor'] = time_calls(
+      train_set.calculate_normalizing_scale_factor, repeats)
+  return datasets
+
+
+def benchmark_rasterize(results, datasets, repeats, num_sketches=1024):
+  """Time drawing num_sketches training sketches as CNN bitmaps."""
+  strokes = datasets[0].strokes
+  num_sketches = min(num_sketches, len(strokes))
+  end = strokes.offsets[num_sketches]
+  points = strokes.points[:end]
+  lengths = np.diff(strokes.offsets[:num_sketches + 1])
+  stats = time_calls(lambda: rasterize.rasterize(points, lengths), repeats)
+  stats['sketches_per_sec'] = num_sketches / stats['median']
+  results['rasterize'] = stats
+  tf.logging.info('rasterize: %.0f sketches/sec', stats['sketches_per_sec'])
+
+
+def benchmark_rnn(results, datasets, repeats):
+  """Time a SketchRNN training step and a full validation pass."""
+  train_set, valid_set, _, model_params, eval_model_params = datasets[:5]
+  sketch_rnn.reset_graph()
+  model = sketch_rnn_model.Model(model_params)
+  eval_model = sketch_rnn_model.Model(eval_model_params, reuse=True)
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    _, labels, x, seq_len = train_set.random_batch()
+    feed = {model.input_data: x, model.y_labels: labels,
+            model.sequence_lengths: seq_len}
+    results['rnn_train_step'] = time_calls(
+        lambda: sess.run(model.train_op, feed), repeats, number=10)
+    results['rnn_eval'] = time_calls(
+        lambda: sketch_rnn.evaluate_model(sess, eval_model, valid_set),
+        repeats)
+
+
+def benchmark_cnn(results, rng, num_images, repeats, batch_size=100):
+  """Time a CNN training step and evaluation on synthetic bitmaps."""
+  import cnn  # pylint: disable=g-import-not-at-top
+  tf.keras.backend.clear_session()
+  size = cnn.image_size
+  images = synthetic.random_bitmaps(rng, num_images, size).reshape(
+      num_images, size, size, 1).astype(np.float32) / 255.0
+  labels = rng.randint(cnn.num_classes, size=num_images)
+  model = cnn.build_model(images.shape[1:])
+  results['cnn_train_step'] = time_calls(
+      lambda: model.train_on_batch(images[:batch_size], labels[:batch_size]),
+      repeats, number=10)
+  results['cnn_eval'] = time_calls(
+      lambda: model.evaluate(images, labels, batch_size=batch_size,
+                             verbose=0), repeats)
+
+
+def compare(results, baseline, threshold):
+  """Log every benchmark against the baseline, return the regressed ones."""
+  regressions = []
+  tf.logging.info('%-36s %12s %12s %8s', 'benchmark', 'baseline_s',
+                  'current_s', 'ratio')
+  for name, current in sorted(results.items()):
+    if name not in baseline:
+      tf.logging.info('%-36s %12s %12.6f %8s', name, '-', current['median'],
+                      'new')
+      continue
+    ratio = current['median'] / baseline[name]['median']
+    regressed = ratio > 1.0 + threshold
+    tf.logging.info('%-36s %12.6f %12.6f %8.3f%s', name,
+                    baseline[name]['median'], current['median'], ratio,
+                    '  REGRESSION' if regressed else '')
+    if regressed:
+      regressions.append(name)
+  return regressions
+
+
+def main(unused_argv):
+  """Run every benchmark, write the results and compare to the baseline."""
+  rng = np.random.RandomState(FLAGS.seed)
+  model_params = sketch_rnn_model.get_default_hparams()
+  if FLAGS.hparams:
+    model_params.parse(FLAGS.hparams)
+  data_dir = tempfile.mkdtemp(prefix='sketch_rnn_benchmark')
+  try:
+    model_params.data_set = synthetic.write_npz_dataset(
+        data_dir, rng, model_params.num_classes, FLAGS.sketches_per_class,
+        FLAGS.sketches_per_class // 10, FLAGS.sketches_per_class // 10)
+    results = {}
+    datasets = benchmark_data(results, data_dir, model_params, FLAGS.repeats)
+    benchmark_rasterize(results, datasets, FLAGS.repeats)
+    benchmark_rnn(results, datasets, FLAGS.repeats)
+    benchmark_cnn(results, rng, FLAGS.sketches_per_class, FLAGS.repeats)
+  finally:
+    shutil.rmtree(data_dir)
+
+  output = {'meta': {'time': time.time(),
+                     'platform': platform.platform(),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'tensorflow': tf.__version__,
+                     'seed': FLAGS.seed,
+                     'sketches_per_class': FLAGS.sketches_per_class,
+                     'hparams': FLAGS.hparams},
+            'results': results}
+  with tf.gfile.Open(FLAGS.benchmark_output, 'w') as f:
+    json.dump(output, f, indent=True)
+  tf.logging.info('Wrote %s.', FLAGS.benchmark_output)
+
+  if FLAGS.baseline:
+    with tf.gfile.Open(FLAGS.baseline) as f:
+      baseline = json.load(f)['results']
+    if compare(results, baseline, FLAGS.regression_threshold):
+      return 1
+  return 0
+
+
+def console_entry_point():
+  tf.app.run(main)
+
+
+if __name__ == '__main__':
+  console_entry_point()
@@ -0,0 +1,166 @@
+"""Asynchronous checkpointing with keep-last and keep-best retention."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent import futures
+import glob
+import json
+import os
+import time
+
+import tensorflow as tf
+
+
+class CheckpointManager(object):
+  """Saves checkpoints on a background thread and prunes old ones.
+
+  save() only blocks training for as long as it takes to copy the variable
+  values out of the session. Those values are then assigned to shadow
+  copies of the variables in a separate graph, which a Saver created once
+  writes to disk on a writer thread. The shadow variables carry the same
+  names, so the files are ordinary checkpoints for load_checkpoint.
+
+  After every write, the keep_last most recent checkpoints and the keep_best
+  ones with the lowest metric are kept and the others are deleted. The kept
+  checkpoints are listed in checkpoints.json, which a new manager on the
+  same directory continues from.
+
+  JSON files passed to save() along with the snapshot, e.g. the sampler
+  positions, are written by the writer thread right after the checkpoint
+  and before it becomes the latest one, so they never get ahead of the
+  checkpoints on disk.
+  """
+
+  def __init__(self, sess, model_save_path, keep_last=5, keep_best=1,
+               var_list=None):
+    """Initializer for the manager.
+
+    Args:
+      sess: the training session to snapshot variables from.
+      model_save_path: directory the checkpoints are written to.
+      keep_last: number of most recent checkpoints to keep, at least 1.
+      keep_best: number of checkpoints with the lowest metric to keep.
+      var_list: variables to save, all global variables by default.
+    """
+    self._sess = sess
+    self.model_save_path = model_save_path
+    self.keep_last = max(keep_last, 1)
+    self.keep_best = keep_best
+    self.var_list = var_list or tf.global_variables()
+    self.blocked_time = 0.0
+    self._checkpoints = []  # dicts with path, step and metric, oldest first.
+    self._graph = tf.Graph()
+    with self._graph.as_default():
+      self._placeholders = []
+      assign_ops = []
+      shadow_vars = {}
+      for var in self.var_list:
+        dtype = var.dtype.base_dtype
+        shadow = tf.Variable(tf.zeros(var.get_shape(), dtype=dtype),
+                             name=var.op.name, trainable=False)
+        placeholder = tf.placeholder(dtype, var.get_shape())
+        self._placeholders.append(placeholder)
+        assign_ops.append(tf.assign(shadow, placeholder))
+        shadow_vars[var.op.name] = shadow
+      self._assign = tf.group(*assign_ops)
+      # retention is handled here, so the saver keeps everything it writes.
+      self._saver = tf.train.Saver(shadow_vars, max_to_keep=None)
+      self._shadow_sess = tf.Session(graph=self._graph)
+      self._shadow_sess.run(tf.variables_initializer(list(shadow_vars.values())))
+    self._executor = futures.ThreadPoolExecutor(1)
+    self._pending = None
+    self._load_index()
+
+  def _load_index(self):
+    """Pick up the checkpoints a previous run kept, e.g. when resuming.
+
+    Entries whose files are gone are dropped, and retention is applied to
+    the rest, so keep_last and keep_best hold across runs.
+    """
+    index_path = os.path.join(self.model_save_path, 'checkpoints.json')
+    if not os.path.exists(index_path):
+      return
+    with open(index_path) as f:
+      checkpoints = json.load(f)
+    self._checkpoints = [c for c in checkpoints
+                         if os.path.exists(c['path'] + '.index')]
+    if self._checkpoints:
+      self._apply_retention()
+
+  def save(self, global_step, metric=None, json_files=None):
+    """Snapshot the variables and queue them to be written.
+
+    Args:
+      global_step: step number appended to the checkpoint name.
+      metric: value to rank checkpoints by for keep_best, lower is better.
+      json_files: optional {file name: JSON-serializable value} to write to
+        model_save_path along with the checkpoint.
+
+    Returns:
+      The number of seconds training was blocked.
+    """
+    start = time.time()
+    # at most one snapshot is in flight; this also surfaces write errors.
+    if self._pending is not None:
+      self._pending.result()
+    values = self._sess.run(self.var_list)
+    self._pending = self._executor.submit(
+        self._write, global_step, metric, values, json_files or {})
+    blocked = time.time() - start
+    self.blocked_time += blocked
+    return blocked
+
+  def _write(self, global_step, metric, values, json_files):
+    """Write one snapshot on the writer thread, then apply retention."""
+    start = time.time()
+    self._shadow_sess.run(
+        self._assign, dict(zip(self._placeholders, values)))
+    path = self._saver.save(
+        self._shadow_sess, os.path.join(self.model_save_path, 'vector'),
+        global_step=global_step, write_meta_graph=False)
+    for name, value in json_files.items():
+      file_path = os.path.join(self.model_save_path, name)
+      with open(file_path + '.tmp', 'w') as f:
+        json.dump(value, f)
+      os.rename(file_path + '.tmp', file_path)
+    self._checkpoints.append(
+        {'path': path, 'step': int(global_step),
+         'metric': None if metric is None else float(metric)})
+    self._apply_retention()
+    tf.logging.info('saved model %s in %.4fs (background).',
+                    path, time.time() - start)
+
+  def _apply_retention(self):
+    """Delete checkpoints that are neither recent nor among the best."""
+    keep = set(c['path'] for c in self._checkpoints[-self.keep_last:])
+    ranked = sorted((c for c in self._checkpoints if c['metric'] is not None),
+                    key=lambda c: c['metric'])
+    keep.update(c['path'] for c in ranked[:self.keep_best])
+    for c in self._checkpoints:
+      if c['path'] not in keep:
+        for filename in glob.glob(c['path'] + '.*'):
+          os.remove(filename)
+    self._checkpoints = [c for c in self._checkpoints if c['path'] in keep]
+    tf.train.update_checkpoint_state(
+        self.model_save_path, self._checkpoints[-1]['path'],
+        all_model_checkpoint_paths=[c['path'] for c in self._checkpoints])
+    with open(os.path.join(self.model_save_path, 'checkpoints.json'),
+              'w') as f:
+      json.dump(self._checkpoints, f, indent=True)
+
+  def best_checkpoint(self):
+    """Return the path of the kept checkpoint with the lowest metric."""
+    ranked = [c for c in self._checkpoints if c['metric'] is not None]
+    if not ranked:
+      return None
+    return min(ranked, key=lambda c: c['metric'])['path']
+
+  def close(self):
+    """Wait for the last write and release the writer thread."""
+    if self._pending is not None:
+      self._pending.result()
+      self._pending = None
+    self._executor.shutdown(wait=True)
+    self._shadow_sess.close()
@@ -1,90 +1,277 @@
 import tensorflow as tf
 from tensorflow.keras import layers
-from tensorflow import keras 
+from tensorflow import keras
 import sklearn
 from sklearn.model_selection import KFold
+import argparse
 import os
-import glob
+import resource
+import time
 import numpy as np
-import urllib
+
+import download
+import rasterize
+import utils_class
 
 classes = ['cat','dog','bear','airplane',
                 'ant','banana','bench','book',
                 'bottlecap','bread']
 
 url = 'https://storage.googleapis.com/quickdraw_dataset/full/numpy_bitmap/'
-# Download the data of the aforementioned classes
-for clas in classes:
-	complete_url = url+clas+".npy"
-	print("Downloading = ",complete_url)
-	urllib.urlretrieve(complete_url, "./"+clas+".npy")
-
-# Grep all the downloaded files and add them to a list
-data_sets = glob.glob(os.path.join('./*.npy'))
-
-#initialize variables 
-input = np.empty([0, 784]) # Train data
-labels = np.empty([0])	# Test data
-
-index = 0
-# Concat the train and test data from all the files
-for file in data_sets:
-	data = np.load(file)
-	data = data[0: 6000, :]
-	input = np.concatenate((input, data), axis=0)
-	labels = np.append(labels, [index]*data.shape[0])
-	index += 1
-
-'''
-	K-Folds cross-validator
-	n_splits : Number of folds to be used
-'''
-n_fold = 5
-kf = KFold(n_splits=n_fold,shuffle=True,random_state=9)
-x_train = None
-x_test = None
-y_train = None
-y_test = None
-random_ordering = np.random.permutation(input.shape[0])
-input = input[random_ordering, :]
-labels = labels[random_ordering]
-for train_index, test_index in kf.split(input):
+# The stroke-3 files of the same classes that sketch_rnn.py trains on.
+stroke_file = 'sketchrnn_%s.npz'
+image_size = 28
+num_classes = len(classes)
+# Where the trained model is saved, for quantize.py and serving.
+model_path = './cnn_model.h5'
+
+
+def download_bitmaps(data_dir='.', num_workers=4, base_url=url):
+    '''
+        Download the data of the aforementioned classes, num_workers files
+        at a time. Files already in data_dir are only fetched again when
+        their size or checksum no longer match, and interrupted downloads
+        are resumed. base_url can point at a local server for testing.
+    '''
+    download.fetch_all(base_url, [clas+".npy" for clas in classes], None,
+                       num_workers, local_dir=data_dir)
+
+
+def load_bitmaps(data_dir='.', samples_per_class=6000):
+    '''
+        Load the first samples_per_class bitmaps of every class into one
+        preallocated uint8 array. The .npy files are memory mapped, so only
+        the rows that are kept are read from disk.
+        Label i is classes[i], so the saved model keeps the same mapping.
+    '''
+    files = [np.load(os.path.join(data_dir, clas+".npy"), mmap_mode='r')
+             for clas in classes]
+    counts = [min(len(data), samples_per_class) for data in files]
+    input = np.empty([sum(counts), image_size*image_size], dtype=np.uint8)
+    labels = np.empty([sum(counts)], dtype=np.int32)
+    begin = 0
+    for index, (data, count) in enumerate(zip(files, counts)):
+        input[begin:begin+count] = data[:count]
+        labels[begin:begin+count] = index
+        begin += count
+    return input, labels
+
+
+def load_stroke_bitmaps(data_dir='.', samples_per_class=6000, cache_dir=None):
+    '''
+        Rasterize the first samples_per_class training sketches of every
+        class from the sketch-rnn stroke files, so the CNN trains on the
+        same data as the RNN instead of the numpy_bitmap download.
+        The sketches go through a DataLoader like in sketch_rnn.py, which
+        sorts them by length, and the bitmaps are kept in cache_dir.
+    '''
+    strokes = []
+    labels = []
+    for index, clas in enumerate(classes):
+        data = np.load(os.path.join(data_dir, stroke_file % clas),
+                       encoding='latin1', allow_pickle=True)
+        sketches = data['train'][:samples_per_class]
+        strokes.append(sketches)
+        labels.append(np.full(len(sketches), index, dtype=np.int32))
+    strokes = np.concatenate(strokes)
+    loader = utils_class.DataLoader(
+        strokes, np.concatenate(labels),
+        max_seq_length=max(len(sketch) for sketch in strokes))
+    start = time.time()
+    input = rasterize.rasterize_strokes(loader.strokes, image_size=image_size,
+                                        cache_dir=cache_dir)
+    print('Rasterized %d sketches in %.2fs' % (len(input), time.time() - start))
+    return input, loader.labels
+
+
+def load_bitmaps_float(data_dir='.', samples_per_class=6000):
+    '''
+        The original float64 loader, growing the array class by class.
+        Only kept to compare memory and time with --legacy_pipeline.
+    '''
+    input = np.empty([0, 784]) # Train data
+    labels = np.empty([0])	# Test data
+    for index, clas in enumerate(classes):
+        data = np.load(os.path.join(data_dir, clas+".npy"))
+        data = data[0: samples_per_class, :]
+        input = np.concatenate((input, data), axis=0)
+        labels = np.append(labels, [index]*data.shape[0])
+    return input, labels
+
+
+def fold_indices(num_samples, n_fold=5, seed=9):
+    '''
+        K-Folds cross-validator
+        n_splits : Number of folds to be used
+        Returns (train, test) sample indices of every fold. They only depend
+        on seed, so quantize.py can rebuild the same test set.
+    '''
+    kf = KFold(n_splits=n_fold,shuffle=True,random_state=seed)
+    random_ordering = np.random.RandomState(seed).permutation(num_samples)
+    return [(random_ordering[train_index], random_ordering[test_index])
+            for train_index, test_index in kf.split(random_ordering)]
+
+
+def split_data(input, labels, n_fold=5, seed=9):
+    '''
+        Returns the first fold as 28 x 28 images, in the dtype of input.
+        Use normalize (or BitmapSequence) to scale uint8 images to [0, 1].
+    '''
     # Divide the dataset into train and test
+    train_index, test_index = fold_indices(len(input), n_fold, seed)[0]
     x_train, x_test = input[train_index], input[test_index]
     y_train, y_test = labels[train_index], labels[test_index]
-    break
 
-# Reshape the image size to be 28 x 28 
-image_size = 28
-x_train = x_train.reshape(x_train.shape[0], image_size, image_size, 1)
-x_test = x_test.reshape(x_test.shape[0], image_size, image_size, 1)
+    # Reshape the image size to be 28 x 28
+    x_train = x_train.reshape(x_train.shape[0], image_size, image_size, 1)
+    x_test = x_test.reshape(x_test.shape[0], image_size, image_size, 1)
+    return x_train, x_test, y_train, y_test
 
-# Divide all the values by 255 to normalize the image
-x_train /= 255.00
-x_test /= 255.00
-num_classes = len(classes)
+
+def normalize(images):
+    # Divide all the values by 255 to normalize the image
+    return images.astype(np.float32) / 255.0
+
+
+class BitmapSequence(keras.utils.Sequence):
+    '''
+        Streams batches of uint8 images to model.fit, normalizing one batch
+        at a time so the dataset never exists as floats. With shuffle the
+        sample order is reshuffled every epoch, like model.fit on arrays.
+        indices restricts the sequence to those samples without copying
+        them, e.g. one fold of a shared array.
+    '''
+
+    def __init__(self, images, labels, batch_size=100, shuffle=False, seed=0,
+                 indices=None):
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        if indices is None:
+            indices = np.arange(len(images))
+        self.order = np.array(indices)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-len(self.order) // self.batch_size)
+
+    def __getitem__(self, idx):
+        batch = self.order[idx*self.batch_size:(idx+1)*self.batch_size]
+        images = self.images[batch].reshape(-1, image_size, image_size, 1)
+        return normalize(images), self.labels[batch]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+class FirstEpochTimer(keras.callbacks.Callback):
+    '''
+        Records the seconds from start until the first epoch is done.
+    '''
+
+    def __init__(self, start):
+        super(FirstEpochTimer, self).__init__()
+        self.start = start
+        self.time_to_first_epoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.time_to_first_epoch is None:
+            self.time_to_first_epoch = time.time() - self.start
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def build_model(input_shape):
+    # CNN Model
+    model = keras.Sequential()
+    model.add(layers.Convolution2D(64, (3, 3),
+                            padding='same',
+                            input_shape=input_shape, activation='relu'))
+    model.add(layers.MaxPooling2D(pool_size=(3, 3)))
+    model.add(layers.Convolution2D(128, (3, 3), padding='same', activation='relu'))
+    model.add(layers.MaxPooling2D(pool_size=(3, 3)))
+    model.add(layers.Convolution2D(64, (3, 3), padding='same', activation='relu'))
+    model.add(layers.MaxPooling2D(pool_size =(3,3)))
+    model.add(layers.Flatten())
+    model.add(layers.Dense(128, activation='relu'))
+    model.add(layers.Dense(num_classes, activation='softmax'))
+    optimizer = tf.train.AdamOptimizer()
+    model.compile(loss='sparse_categorical_crossentropy',
+                  optimizer=optimizer,
+                  metrics=['accuracy'])
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the QuickDraw CNN.')
+    parser.add_argument('--data_dir', default='.')
+    parser.add_argument('--samples_per_class', type=int, default=6000)
+    parser.add_argument('--epochs', type=int, default=15)
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--download_workers', type=int, default=4,
+                        help='number of class files downloaded at once')
+    parser.add_argument('--legacy_pipeline', action='store_true',
+                        help='load and train on float arrays like before, '
+                             'to compare peak RSS and time to first epoch')
+    parser.add_argument('--from_strokes', action='store_true',
+                        help='rasterize the sketchrnn_<class>.npz stroke '
+                             'files in data_dir instead of downloading the '
+                             'numpy_bitmap files')
+    parser.add_argument('--raster_cache_dir',
+                        default='/tmp/sketch_rnn/bitmap_cache',
+                        help='where rasterized strokes are cached, empty '
+                             'to disable')
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+    if not args.from_strokes:
+        download_bitmaps(args.data_dir, args.download_workers)
+    start = time.time()
+    timer = FirstEpochTimer(start)
+    if args.legacy_pipeline:
+        input, labels = load_bitmaps_float(args.data_dir, args.samples_per_class)
+        x_train, x_test, y_train, y_test = split_data(input, labels)
+        x_train /= 255.00
+        x_test /= 255.00
+        model = build_model(x_train.shape[1:])
+        # Fit a model to the train data
+        model.fit(x = x_train, y = y_train, batch_size = args.batch_size,
+                  validation_split = 0.2, epochs=args.epochs, callbacks=[timer])
+        # Obtain the accuracy of the above model on the test data
+        accuracy = model.evaluate(x_test, y_test)
+    else:
+        if args.from_strokes:
+            input, labels = load_stroke_bitmaps(
+                args.data_dir, args.samples_per_class, args.raster_cache_dir)
+        else:
+            input, labels = load_bitmaps(args.data_dir, args.samples_per_class)
+        x_train, x_test, y_train, y_test = split_data(input, labels)
+        # the last 20% of the training fold validates, like validation_split.
+        split_at = int(len(x_train) * 0.8)
+        train_batches = BitmapSequence(x_train[:split_at], y_train[:split_at],
+                                       args.batch_size, shuffle=True)
+        valid_batches = BitmapSequence(x_train[split_at:], y_train[split_at:],
+                                       args.batch_size)
+        model = build_model(x_train.shape[1:])
+        # Fit a model to the train data
+        model.fit(train_batches, validation_data=valid_batches,
+                  epochs=args.epochs, callbacks=[timer])
+        # Obtain the accuracy of the above model on the test data
+        accuracy = model.evaluate(BitmapSequence(x_test, y_test, args.batch_size))
+    print('Test accuracy',accuracy[1] * 100)
+    print('Peak RSS %.1f MB, time to first epoch %.2fs' % (
+        peak_rss_mb(), timer.time_to_first_epoch))
+
+    # The tf.train optimizer can not be serialized, only the weights are kept.
+    model.save(model_path, include_optimizer=False)
+    print('Saved model to', model_path)
 
 
-# CNN Model
-model = keras.Sequential()
-model.add(layers.Convolution2D(64, (3, 3),
-                        padding='same',
-                        input_shape=x_train.shape[1:], activation='relu'))
-model.add(layers.MaxPooling2D(pool_size=(3, 3)))
-model.add(layers.Convolution2D(128, (3, 3), padding='same', activation='relu'))
-model.add(layers.MaxPooling2D(pool_size=(3, 3)))
-model.add(layers.Convolution2D(64, (3, 3), padding='same', activation='relu'))
-model.add(layers.MaxPooling2D(pool_size =(3,3)))
-model.add(layers.Flatten())
-model.add(layers.Dense(128, activation='relu'))
-model.add(layers.Dense(num_classes, activation='softmax')) 
-optimizer = tf.train.AdamOptimizer()
-model.compile(loss='sparse_categorical_crossentropy',
-              optimizer=optimizer,
-              metrics=['accuracy'])
-# Fit a model to the train data
-model.fit(x = x_train, y = y_train, batch_size = 100,  validation_split = 0.2, epochs=15)
-
-# Obtain the accuracy of the above model on the test data
-accuracy = model.evaluate(x_test, y_test)
-print('Test accuracy',accuracy[1] * 100)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Parallel k-fold cross-validation of the CNN in cnn.py.
+
+Every fold is trained and evaluated in its own worker process. The uint8
+bitmaps are loaded once into a shared multiprocessing.RawArray that the
+workers map instead of receiving a copy, and each fold reads its samples straight from
+it through cnn.BitmapSequence. The CPU threads are split between the
+workers, so num_workers TensorFlow sessions do not oversubscribe the
+machine. Reports the mean and std test accuracy over folds and the wall
+clock speedup over training the folds one after another.
+
+  python cnn_cv.py --folds 5 --workers 5
+  python cnn_cv.py --folds 5 --workers 5 --compare_serial
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+from concurrent import futures
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import cnn
+
+# views of the shared bitmaps mapped by each worker process.
+_worker_images = None
+_worker_labels = None
+
+
+def _init_worker(shared, shape, labels, num_threads):
+  """Map the shared bitmaps and limit the threads TensorFlow may use."""
+  global _worker_images, _worker_labels
+  os.environ['OMP_NUM_THREADS'] = str(num_threads)
+  tf.keras.backend.set_session(tf.Session(config=tf.ConfigProto(
+      intra_op_parallelism_threads=num_threads,
+      inter_op_parallelism_threads=min(num_threads, 2))))
+  _worker_images = np.frombuffer(shared, dtype=np.uint8).reshape(shape)
+  _worker_labels = labels
+
+
+def _train_fold(fold, train_index, test_index, epochs, batch_size):
+  """Train and test one fold, return (fold, accuracy, seconds)."""
+  start = time.time()
+  model = cnn.build_model((cnn.image_size, cnn.image_size, 1))
+  model.fit(cnn.BitmapSequence(_worker_images, _worker_labels, batch_size,
+                               shuffle=True, seed=fold, indices=train_index),
+            epochs=epochs, verbose=0)
+  accuracy = model.evaluate(
+      cnn.BitmapSequence(_worker_images, _worker_labels, batch_size,
+                         indices=test_index), verbose=0)[1]
+  return fold, float(accuracy), time.time() - start
+
+
+def cross_validate(images, labels, n_fold=5, num_workers=5, num_threads=None,
+                   epochs=15, batch_size=100):
+  """Train all n_fold folds on num_workers processes.
+
+  Args:
+    images: uint8 array of flattened bitmaps, as cnn.load_bitmaps returns.
+    labels: int array of class labels.
+    n_fold: number of folds.
+    num_workers: number of worker processes training folds at once.
+    num_threads: total CPU threads to split between the workers, all CPUs
+      by default.
+    epochs: training epochs per fold.
+    batch_size: training batch size.
+
+  Returns:
+    The test accuracy of every fold, their training times and the wall
+    clock seconds of the whole run.
+  """
+  num_threads = num_threads or os.cpu_count() or 1
+  threads_per_worker = max(1, num_threads // num_workers)
+  # spawned workers start without the parent's TensorFlow state, and get
+  # the shared array handed over when they start.
+  context = multiprocessing.get_context('spawn')
+  shared = context.RawArray('B', images.nbytes)
+  np.frombuffer(shared, dtype=np.uint8).reshape(images.shape)[:] = images
+  start = time.time()
+  with futures.ProcessPoolExecutor(
+      num_workers, mp_context=context, initializer=_init_worker,
+      initargs=(shared, images.shape, labels, threads_per_worker)) as pool:
+    pending = [
+        pool.submit(_train_fold, fold, train_index, test_index, epochs,
+                    batch_size)
+        for fold, (train_index, test_index) in enumerate(
+            cnn.fold_indices(len(images), n_fold))]
+    accuracies = np.zeros(n_fold)
+    fold_times = np.zeros(n_fold)
+    for future in futures.as_completed(pending):
+      fold, accuracy, seconds = future.result()
+      accuracies[fold] = accuracy
+      fold_times[fold] = seconds
+      print('fold %d: accuracy %.2f%%, %.1fs' % (fold, accuracy * 100,
+                                                  seconds))
+  wall_time = time.time() - start
+  return accuracies, fold_times, wall_time
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--data_dir', default='.')
+  parser.add_argument('--samples_per_class', type=int, default=6000)
+  parser.add_argument('--folds', type=int, default=5)
+  parser.add_argument('--workers', type=int, default=5)
+  parser.add_argument('--threads', type=int, default=None,
+                      help='CPU threads to split between the workers')
+  parser.add_argument('--epochs', type=int, default=15)
+  parser.add_argument('--batch_size', type=int, default=100)
+  parser.add_argument('--compare_serial', action='store_true',
+                      help='also time the folds on one worker with all '
+                           'threads, to measure the speedup')
+  args = parser.parse_args()
+
+  images, labels = cnn.load_bitmaps(args.data_dir, args.samples_per_class)
+  accuracies, fold_times, wall_time = cross_validate(
+      images, labels, args.folds, args.workers, args.threads, args.epochs,
+      args.batch_size)
+  print('accuracy over %d folds: mean %.2f%%, std %.2f%%' % (
+      args.folds, np.mean(accuracies) * 100, np.std(accuracies) * 100))
+  print('wall clock %.1fs on %d workers' % (wall_time, args.workers))
+  if args.compare_serial:
+    _, _, serial_time = cross_validate(
+        images, labels, args.folds, 1, args.threads, args.epochs,
+        args.batch_size)
+    print('wall clock %.1fs on 1 worker, speedup %.2fx' % (
+        serial_time, serial_time / wall_time))
+  else:
+    # folds trained with fewer threads each, so this is only an estimate.
+    print('summed fold time %.1fs, estimated speedup %.2fx' % (
+        np.sum(fold_times), np.sum(fold_times) / wall_time))
+
+
+if __name__ == '__main__':
+  main()
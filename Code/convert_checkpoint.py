@@ -0,0 +1,116 @@
+"""Convert an 'lstm' encoder checkpoint to the 'lstm_fused' encoder.
+
+The magenta LSTMCell keeps separate W_xh and W_hh matrices, where the fused
+LSTMBlockFusedCell keeps one kernel holding W_xh stacked on W_hh. Both use
+the i, j, f, o gate order and a forget bias of 1.0, and the bias is shared
+as is, so without dropout the converted model computes the same function.
+With recurrent dropout the fused encoder drops out the final states instead
+of every step, see Model.fused_encoder. The Adam slots of the weights are
+converted the same way, so training can continue from the converted
+checkpoint. LSTMCell variables the conversion does not know are an error
+rather than being left out of the converted checkpoint.
+
+  python convert_checkpoint.py --log_root=/tmp/sketch_rnn/models/default \
+      --output_dir=/tmp/sketch_rnn/models/fused
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import sketch_rnn
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string(
+    'output_dir', '', 'Directory the converted checkpoint is written to.')
+
+# the variable scope magenta's LSTMCell creates its weights in, and the
+# suffixes of the optimizer slots kept next to them.
+LSTM_SCOPE = '/LSTMCell/'
+SLOT_SUFFIXES = ('', '/Adam', '/Adam_1')
+
+
+def convert_variables(values):
+  """Map {name: value} of an 'lstm' checkpoint to 'lstm_fused' names.
+
+  Raises:
+    ValueError: if an LSTMCell variable has no fused counterpart, e.g. the
+      slot of another optimizer or a W_xh without its W_hh.
+  """
+  converted = {}
+  unmapped = []
+  for name, value in values.items():
+    if LSTM_SCOPE not in name:
+      converted[name] = value
+      continue
+    scope, rest = name.split(LSTM_SCOPE)
+    for suffix in SLOT_SUFFIXES:
+      w_xh_name = scope + LSTM_SCOPE + 'W_xh' + suffix
+      w_hh_name = scope + LSTM_SCOPE + 'W_hh' + suffix
+      if rest == 'W_xh' + suffix and w_hh_name in values:
+        converted[scope + '/kernel' + suffix] = np.concatenate(
+            [value, values[w_hh_name]], axis=0)
+        break
+      if rest == 'W_hh' + suffix and w_xh_name in values:
+        break  # stacked into the kernel along with W_xh.
+      if rest == 'bias' + suffix:
+        converted[scope + '/bias' + suffix] = value
+        break
+    else:
+      unmapped.append(name)
+  if unmapped:
+    raise ValueError('Can not convert LSTMCell variables %s.' %
+                     ', '.join(sorted(unmapped)))
+  return converted
+
+
+def convert_checkpoint(checkpoint_path, output_dir):
+  """Convert the latest checkpoint in checkpoint_path into output_dir."""
+  hps = sketch_rnn.load_model_params(checkpoint_path)
+  if hps.enc_model != 'lstm':
+    raise ValueError('Can only convert lstm encoders, not %s.' % hps.enc_model)
+  prefix = tf.train.latest_checkpoint(checkpoint_path)
+  reader = tf.train.load_checkpoint(prefix)
+  values = {name: reader.get_tensor(name)
+            for name in reader.get_variable_to_shape_map()}
+  converted = convert_variables(values)
+
+  with tf.Graph().as_default():
+    variables = {name: tf.Variable(value, name=name)
+                 for name, value in converted.items()}
+    saver = tf.train.Saver(variables)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      tf.gfile.MakeDirs(output_dir)
+      path = saver.save(
+          sess, os.path.join(output_dir, os.path.basename(prefix)),
+          write_meta_graph=False)
+
+  hps.enc_model = 'lstm_fused'
+  with tf.gfile.Open(os.path.join(output_dir, 'model_config.json'), 'w') as f:
+    json.dump(hps.values(), f, indent=True)
+  normalization = os.path.join(checkpoint_path, 'normalization.json')
+  if tf.gfile.Exists(normalization):
+    tf.gfile.Copy(normalization,
+                  os.path.join(output_dir, 'normalization.json'),
+                  overwrite=True)
+  tf.logging.info('Converted %s to %s.', prefix, path)
+
+
+def main(unused_argv):
+  convert_checkpoint(FLAGS.log_root, FLAGS.output_dir)
+
+
+def console_entry_point():
+  tf.app.run(main)
+
+
+if __name__ == '__main__':
+  console_entry_point()
@@ -0,0 +1,130 @@
+"""Content-addressed on-disk cache of the preprocessed SketchRNN dataset.
+
+An entry holds the normalized train/valid/test splits in the flat layout used
+by DataLoader (points, offsets, labels) as .npy files, so a warm start maps
+them in with np.load(mmap_mode='c') instead of rebuilding them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Bump whenever the preprocessing in load_dataset or DataLoader changes, so
+# entries written by older code are never mapped in.
+PREPROCESS_VERSION = 1
+
+SPLITS = ('train', 'valid', 'test')
+_ARRAYS = ('points', 'offsets', 'labels')
+
+
+def file_digest(path, cache_dir=None):
+  """Return the sha256 of a file, memoized on (size, mtime) in cache_dir."""
+  path = os.path.abspath(path)
+  stat = os.stat(path)
+  index_path = None
+  index = {}
+  if cache_dir:
+    index_path = os.path.join(cache_dir, 'file_digests.json')
+    if os.path.exists(index_path):
+      with open(index_path) as f:
+        index = json.load(f)
+    entry = index.get(path)
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+      return entry[2]
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha.update(chunk)
+  digest = sha.hexdigest()
+  if index_path:
+    index[path] = [stat.st_size, stat.st_mtime, digest]
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(index, f)
+    os.rename(tmp_path, index_path)
+  return digest
+
+
+def cache_key(data_set, file_paths, params, cache_dir=None):
+  """Build the key of a cache entry.
+
+  Args:
+    data_set: the data_set hparam, as a list of file names.
+    file_paths: the local source files, hashed by content.
+    params: dict of preprocessing parameters that change the output.
+    cache_dir: where file digests are memoized.
+
+  Returns:
+    A hex digest naming the cache entry.
+  """
+  description = {
+      'version': PREPROCESS_VERSION,
+      'data_set': list(data_set),
+      'files': [file_digest(p, cache_dir) for p in file_paths],
+      'params': params,
+  }
+  return hashlib.sha256(
+      json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load(cache_dir, key):
+  """Map a cache entry in, or return None when there is none.
+
+  Returns:
+    A dict with 'meta' (the metadata passed to save) and, for each split, a
+    (points, offsets, labels) tuple of copy-on-write memory maps.
+  """
+  entry_dir = os.path.join(cache_dir, key)
+  meta_path = os.path.join(entry_dir, 'meta.json')
+  if not os.path.exists(meta_path):
+    return None
+  with open(meta_path) as f:
+    result = {'meta': json.load(f)}
+  for split in SPLITS:
+    result[split] = tuple(
+        np.load(os.path.join(entry_dir, '%s_%s.npy' % (split, name)),
+                mmap_mode='c') for name in _ARRAYS)
+  return result
+
+
+def save(cache_dir, key, splits, meta):
+  """Write a cache entry.
+
+  The entry is written to a temporary directory and renamed into place, so
+  a crashed or concurrent writer never leaves a half written entry behind.
+
+  Args:
+    cache_dir: root directory of the cache.
+    key: the entry name returned by cache_key.
+    splits: dict mapping each split name to its DataLoader.
+    meta: JSON-serializable metadata stored alongside, e.g. scale factor.
+  """
+  entry_dir = os.path.join(cache_dir, key)
+  if os.path.exists(entry_dir):
+    return
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+  try:
+    for split in SPLITS:
+      for name in _ARRAYS:
+        np.save(os.path.join(tmp_dir, '%s_%s.npy' % (split, name)),
+                getattr(splits[split], name))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+      json.dump(meta, f)
+    os.rename(tmp_dir, entry_dir)
+  except OSError:
+    # another process may have won the race to create the same entry.
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not os.path.exists(entry_dir):
+      raise
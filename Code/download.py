@@ -0,0 +1,253 @@
+"""Cached, resumable downloads of remote dataset files.
+
+Only plain HEAD and GET requests are made, so everything here can be
+exercised against a local stand-in such as python -m http.server by
+pointing the url at it. Servers that ignore Range requests, like that one,
+simply get the whole file downloaded again instead of resumed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import binascii
+from concurrent import futures
+import hashlib
+import json
+import os
+import time
+
+import requests
+import tensorflow as tf
+
+
+def is_remote(path):
+  """Return True if path is an http(s) URL."""
+  return path.startswith('http://') or path.startswith('https://')
+
+
+def _read_meta(meta_path):
+  if not os.path.exists(meta_path):
+    return {}
+  with open(meta_path) as f:
+    return json.load(f)
+
+
+def _write_meta(meta_path, meta):
+  tmp_path = meta_path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(meta, f)
+  os.rename(tmp_path, meta_path)
+
+
+def file_md5(path, chunk_size=1 << 20):
+  """Return the hex MD5 digest of the file at path."""
+  digest = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _remote_md5(headers):
+  """Return the hex MD5 the server advertises for a file, or None.
+
+  Google Cloud Storage sends it as x-goog-hash: crc32c=...,md5=<base64>,
+  other servers may send a base64 Content-MD5 header.
+  """
+  values = [value.strip() for value in
+            headers.get('x-goog-hash', '').split(',')]
+  values = [value[4:] for value in values if value.startswith('md5=')]
+  if headers.get('Content-MD5'):
+    values.append(headers['Content-MD5'])
+  for value in values:
+    try:
+      return binascii.hexlify(base64.b64decode(value)).decode('ascii')
+    except (binascii.Error, ValueError):
+      continue
+  return None
+
+
+def _same_version(meta, url, etag, size):
+  """Return True if meta describes the remote file (url, etag, size)."""
+  if meta.get('url') != url:
+    return False
+  if etag and meta.get('etag'):
+    return meta['etag'] == etag
+  return size >= 0 and meta.get('size') == size
+
+
+def _cached_md5(path, meta):
+  """Return the MD5 of path, memoized in meta on the file's size and mtime."""
+  stat = os.stat(path)
+  if (meta.get('md5') and meta.get('size') == stat.st_size and
+      meta.get('mtime') == stat.st_mtime):
+    return meta['md5']
+  return file_md5(path)
+
+
+def _is_cached(path, meta_path, meta, url, etag, size, md5):
+  """Return True if path holds the remote file, by size and checksum.
+
+  A file without metadata, e.g. one copied there by hand, is only trusted
+  when the server advertises an MD5 to check it against. The metadata is
+  (re)written once the file checks out, so later runs skip hashing it.
+  """
+  if not os.path.exists(path):
+    return False
+  if size >= 0 and os.path.getsize(path) != size:
+    return False
+  if meta:
+    if not _same_version(meta, url, etag, size):
+      return False
+  elif md5 is None:
+    return False
+  expected = md5 or meta.get('md5')
+  digest = _cached_md5(path, meta)
+  if expected is not None and digest != expected:
+    return False
+  stat = os.stat(path)
+  if (meta.get('md5') != digest or meta.get('size') != stat.st_size or
+      meta.get('mtime') != stat.st_mtime):
+    _write_meta(meta_path, {'url': url, 'etag': etag, 'size': stat.st_size,
+                            'md5': digest, 'mtime': stat.st_mtime})
+  return True
+
+
+def fetch(url, path, chunk_size=1 << 16, session=None, md5=None, stats=None):
+  """Download url to path, unless an up to date copy is already there.
+
+  The file is streamed to path + '.part' in chunks. An interrupted download
+  is resumed with a range request as long as the remote ETag (or, without
+  one, the size) still matches, and the finished file is only moved to path
+  once its size and MD5 check out. The url, ETag, size and MD5 are kept in
+  path + '.meta.json', and a cached copy is only used when its size and
+  MD5 still match them. The MD5 of a cached copy is only computed again
+  when its size or mtime changed.
+
+  Args:
+    url: the http(s) URL to fetch.
+    path: local destination of the file.
+    chunk_size: number of bytes read from the connection at a time.
+    session: optional requests.Session to issue the requests with.
+    md5: optional expected hex MD5 of the file. By default the MD5 the
+      server advertises is checked, if it sends one.
+    stats: optional dict updated with the 'bytes' downloaded, the
+      'seconds' taken and whether the file was 'cached'.
+
+  Returns:
+    path.
+  """
+  start = time.time()
+  stats = stats if stats is not None else {}
+  stats.update({'bytes': 0, 'seconds': 0.0, 'cached': True})
+  session = session or requests.Session()
+  meta_path = path + '.meta.json'
+  part_path = path + '.part'
+  meta = _read_meta(meta_path)
+  try:
+    response = session.head(url, allow_redirects=True, timeout=60)
+    response.raise_for_status()
+  except requests.RequestException:
+    if os.path.exists(path):
+      tf.logging.info('Could not reach %s, using cached %s.', url, path)
+      return path
+    raise
+  etag = response.headers.get('ETag')
+  size = int(response.headers.get('Content-Length', -1))
+  md5 = md5 or _remote_md5(response.headers)
+  if _is_cached(path, meta_path, meta, url, etag, size, md5):
+    return path
+  stats['cached'] = False
+
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  offset = 0
+  if os.path.exists(part_path) and _same_version(meta, url, etag, size):
+    offset = os.path.getsize(part_path)
+  headers = {}
+  if offset:
+    headers['Range'] = 'bytes=%d-' % offset
+    if etag:
+      headers['If-Range'] = etag
+  _write_meta(meta_path, {'url': url, 'etag': etag, 'size': size})
+  response = session.get(url, headers=headers, stream=True, timeout=60)
+  digest = hashlib.md5()
+  try:
+    response.raise_for_status()
+    if response.status_code != 206:
+      offset = 0  # the server sent the whole file.
+    if offset:
+      tf.logging.info('Resuming %s at byte %i.', url, offset)
+      with open(part_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+          digest.update(chunk)
+    else:
+      tf.logging.info('Downloading %s', url)
+    with open(part_path, 'ab' if offset else 'wb') as f:
+      for chunk in response.iter_content(chunk_size):
+        f.write(chunk)
+        digest.update(chunk)
+        stats['bytes'] += len(chunk)
+  finally:
+    response.close()
+  received = os.path.getsize(part_path)
+  if size >= 0 and received != size:
+    raise IOError('Downloaded %i of %i bytes of %s.' % (received, size, url))
+  if md5 is not None and digest.hexdigest() != md5:
+    os.remove(part_path)
+    raise IOError('MD5 mismatch for %s: expected %s, got %s.' % (
+        url, md5, digest.hexdigest()))
+  # the rename keeps the mtime, which memoizes the MD5 for later runs.
+  _write_meta(meta_path, {'url': url, 'etag': etag, 'size': received,
+                          'md5': digest.hexdigest(),
+                          'mtime': os.stat(part_path).st_mtime})
+  os.rename(part_path, path)
+  stats['seconds'] = time.time() - start
+  tf.logging.info('Fetched %s: %.1f MB in %.1fs (%.2f MB/s).', url,
+                  stats['bytes'] / 2.0**20, stats['seconds'],
+                  stats['bytes'] / 2.0**20 / max(stats['seconds'], 1e-6))
+  return path
+
+
+def fetch_all(base_url, names, cache_dir, num_workers=4, local_dir=None):
+  """Fetch base_url/name for every name into a local mirror directory.
+
+  At most num_workers files are downloaded at once. Files already cached
+  with a matching size and checksum are skipped, and the combined
+  bandwidth of the ones downloaded is logged.
+
+  Args:
+    base_url: http(s) URL of the directory holding the files.
+    names: file names to fetch from base_url.
+    cache_dir: directory holding one mirror directory per base_url.
+    num_workers: number of concurrent downloads.
+    local_dir: optional directory to fetch into instead of the mirror in
+      cache_dir.
+
+  Returns:
+    The local directory that mirrors base_url, so that
+    os.path.join(result, name) is the cached copy of each file.
+  """
+  if local_dir is None:
+    key = hashlib.sha1(base_url.encode('utf-8')).hexdigest()[:16]
+    local_dir = os.path.join(cache_dir, key)
+  start = time.time()
+  stats = [{} for _ in names]
+  with futures.ThreadPoolExecutor(num_workers) as pool:
+    pending = [
+        pool.submit(fetch, base_url.rstrip('/') + '/' + name,
+                    os.path.join(local_dir, name), stats=file_stats)
+        for name, file_stats in zip(names, stats)]
+    for future in pending:
+      future.result()
+  elapsed = time.time() - start
+  downloaded = [s for s in stats if not s.get('cached', True)]
+  total = sum(s['bytes'] for s in downloaded)
+  tf.logging.info('%i/%i files cached, fetched %i (%.1f MB) in %.1fs, '
+                  '%.2f MB/s.', len(names) - len(downloaded), len(names),
+                  len(downloaded), total / 2.0**20, elapsed,
+                  total / 2.0**20 / max(elapsed, 1e-6))
+  return local_dir
@@ -0,0 +1,102 @@
+"""Compare training and inference speed of the encoder cells.
+
+Builds the classifier with every enc_model in --encoders and times, on
+synthetic sketches, training steps per second at the training batch size
+and the latency of classifying a single sketch.
+
+  python encoder_benchmark.py --encoders=lstm,layer_norm,hyper,lstm_fused
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import model as sketch_rnn_model
+import sketch_rnn
+import utils_class as utils
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string(
+    'encoders', 'lstm,layer_norm,hyper,lstm_fused',
+    'Comma separated enc_model values to benchmark.')
+tf.app.flags.DEFINE_integer(
+    'train_steps', 50, 'Number of timed training steps per encoder.')
+tf.app.flags.DEFINE_integer(
+    'inference_runs', 200, 'Number of timed single sketch predictions.')
+tf.app.flags.DEFINE_integer(
+    'benchmark_seq_len', 100, 'Number of points of the synthetic sketches.')
+
+
+def synthetic_batch(rng, batch_size, seq_len):
+  """Return (stroke-5 batch, lengths) of random sketches of seq_len points."""
+  lengths = np.full(batch_size, seq_len, dtype=np.int64)
+  points = np.zeros((batch_size * seq_len, 3), dtype=np.float32)
+  points[:, 0:2] = rng.randn(batch_size * seq_len, 2)
+  points[:, 2] = rng.rand(batch_size * seq_len) < 0.1
+  return utils.stroke_3_to_5(points, lengths, seq_len), lengths
+
+
+def benchmark_encoder(model_params, num_steps, num_runs, seq_len):
+  """Return (training steps/sec, median single sketch latency in ms)."""
+  sketch_rnn.reset_graph()
+  model = sketch_rnn_model.Model(model_params)
+  inference_params = sketch_rnn_model.copy_hparams(model_params)
+  inference_params.use_recurrent_dropout = 0
+  inference_params.is_training = 0
+  inference_model = sketch_rnn_model.Model(inference_params, reuse=True)
+  rng = np.random.RandomState(0)
+  x, lengths = synthetic_batch(rng, model_params.batch_size, seq_len)
+  labels = rng.randint(model_params.num_classes, size=model_params.batch_size)
+  feed = {model.input_data: x, model.sequence_lengths: lengths,
+          model.y_labels: labels}
+  x_one, lengths_one = synthetic_batch(rng, 1, seq_len)
+  feed_one = {inference_model.input_data: x_one,
+              inference_model.sequence_lengths: lengths_one}
+
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(model.train_op, feed)  # warm up
+    start = time.time()
+    for _ in range(num_steps):
+      sess.run(model.train_op, feed)
+    steps_per_sec = num_steps / (time.time() - start)
+
+    sess.run(inference_model.output, feed_one)
+    latencies = []
+    for _ in range(num_runs):
+      start = time.time()
+      sess.run(inference_model.output, feed_one)
+      latencies.append(time.time() - start)
+  return steps_per_sec, np.median(latencies) * 1000
+
+
+def main(unused_argv):
+  """Benchmark every encoder in --encoders and log a table."""
+  results = []
+  for enc_model in FLAGS.encoders.split(','):
+    model_params = sketch_rnn_model.get_default_hparams()
+    if FLAGS.hparams:
+      model_params.parse(FLAGS.hparams)
+    model_params.enc_model = enc_model
+    results.append((enc_model,) + benchmark_encoder(
+        model_params, FLAGS.train_steps, FLAGS.inference_runs,
+        FLAGS.benchmark_seq_len))
+
+  tf.logging.info('%-12s %14s %20s', 'enc_model', 'train_steps_s',
+                  'inference_latency_ms')
+  for enc_model, steps_per_sec, latency in results:
+    tf.logging.info('%-12s %14.2f %20.3f', enc_model, steps_per_sec, latency)
+
+
+def console_entry_point():
+  tf.app.run(main)
+
+
+if __name__ == '__main__':
+  console_entry_point()
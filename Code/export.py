@@ -0,0 +1,168 @@
+"""Export a trained SketchRNN classifier as a frozen inference graph.
+
+The exported GraphDef only holds what classification needs: the encoder and
+the output_w/output_b projection with their weights folded into constants,
+plus the data normalization (scale factor and clamp limit) and the class
+labels. Optimizer slots, the learning rate and global_step are left behind.
+
+  python export.py --log_root=/tmp/sketch_rnn/models/default
+  python export.py --log_root=... --benchmark
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import model as sketch_rnn_model
+import sketch_rnn
+import utils_class as utils
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string(
+    'export_path', '',
+    'Where to write the frozen graph. Defaults to log_root/frozen_model.pb.')
+tf.app.flags.DEFINE_boolean(
+    'benchmark', False,
+    'Set to true to compare loading the frozen graph with restoring the full '
+    'training checkpoint.')
+
+INPUT_DATA = 'vector_rnn/input_data:0'
+SEQUENCE_LENGTHS = 'vector_rnn/sequence_lengths:0'
+OUTPUT = 'vector_rnn/output'
+SCALE_FACTOR = 'normalization/scale_factor'
+LIMIT = 'normalization/limit'
+LABELS = 'labels'
+
+
+def export_frozen_graph(checkpoint_path, export_path):
+  """Freeze the latest checkpoint in checkpoint_path into export_path."""
+  hps = sketch_rnn.load_model_params(checkpoint_path, inference=True)
+  scale_factor, limit = sketch_rnn.load_normalization(checkpoint_path)
+  graph = tf.Graph()
+  with graph.as_default():
+    sketch_rnn_model.Model(hps)
+    tf.constant(scale_factor, dtype=tf.float32, name=SCALE_FACTOR)
+    tf.constant(limit, dtype=tf.float32, name=LIMIT)
+    tf.constant(list(hps.data_set), name=LABELS)
+    with tf.Session() as sess:
+      sketch_rnn.load_checkpoint(sess, checkpoint_path)
+      # also drops every node the outputs do not depend on.
+      graph_def = tf.graph_util.convert_variables_to_constants(
+          sess, graph.as_graph_def(), [OUTPUT, SCALE_FACTOR, LIMIT, LABELS])
+  with tf.gfile.GFile(export_path, 'wb') as f:
+    f.write(graph_def.SerializeToString())
+  tf.logging.info('Wrote frozen graph with %i nodes to %s.',
+                  len(graph_def.node), export_path)
+
+
+class FrozenSketchClassifier(object):
+  """Classifies stroke-3 sketches with a graph written by export_frozen_graph.
+
+  Has the same labels and predict interface as serve.SketchClassifier.
+  """
+
+  def __init__(self, export_path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(export_path, 'rb') as f:
+      graph_def.ParseFromString(f.read())
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      tf.import_graph_def(graph_def, name='')
+    self.sess = tf.Session(graph=self.graph)
+    self.input_data = self.graph.get_tensor_by_name(INPUT_DATA)
+    self.sequence_lengths = self.graph.get_tensor_by_name(SEQUENCE_LENGTHS)
+    self.output = self.graph.get_tensor_by_name(OUTPUT + ':0')
+    scale_factor, limit, labels = self.sess.run(
+        [SCALE_FACTOR + ':0', LIMIT + ':0', LABELS + ':0'])
+    self.scale_factor = float(scale_factor)
+    self.limit = float(limit)
+    self.labels = [label.decode('utf-8') for label in labels]
+
+  def predict(self, sketches):
+    """Return the logits of a list of stroke-3 sketches."""
+    x, lengths = utils.normalize_and_pad(
+        sketches, self.scale_factor, self.limit)
+    feed = {self.input_data: x, self.sequence_lengths: lengths}
+    return self.sess.run(self.output, feed)
+
+
+def _rss_mb():
+  """Return the resident set size of this process in MB (Linux only)."""
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith('VmRSS:'):
+        return int(line.split()[1]) / 1024.0
+  return float('nan')
+
+
+def benchmark(checkpoint_path, export_path):
+  """Log load time, first prediction latency, size and RSS of both artifacts.
+
+  The frozen graph is measured first, so the memory growth of the full
+  restore also includes what TensorFlow keeps around from the first load.
+  """
+  rng = np.random.RandomState(0)
+  sketch = np.zeros((60, 3), dtype=np.float32)
+  sketch[:, 0:2] = rng.randint(-30, 31, size=(60, 2))
+  sketch[-1, 2] = 1
+
+  rss = _rss_mb()
+  start = time.time()
+  classifier = FrozenSketchClassifier(export_path)
+  frozen_load = time.time() - start
+  start = time.time()
+  classifier.predict([sketch])
+  frozen_first = time.time() - start
+  frozen_rss = _rss_mb() - rss
+  frozen_size = os.path.getsize(export_path)
+
+  rss = _rss_mb()
+  start = time.time()
+  sketch_rnn.reset_graph()
+  model = sketch_rnn_model.Model(sketch_rnn.load_model_params(checkpoint_path))
+  sess = tf.Session()
+  sketch_rnn.load_checkpoint(sess, checkpoint_path)
+  full_load = time.time() - start
+  scale_factor, limit = sketch_rnn.load_normalization(checkpoint_path)
+  start = time.time()
+  x, lengths = utils.normalize_and_pad([sketch], scale_factor, limit)
+  sess.run(model.output, {model.input_data: x,
+                          model.sequence_lengths: lengths})
+  full_first = time.time() - start
+  full_rss = _rss_mb() - rss
+  prefix = tf.train.get_checkpoint_state(
+      checkpoint_path).model_checkpoint_path
+  full_size = sum(os.path.getsize(p) for p in glob.glob(prefix + '.*'))
+
+  tf.logging.info('%-12s %10s %12s %10s %10s', 'artifact', 'load_s',
+                  'first_run_s', 'size_MB', 'rss_MB')
+  for name, load, first, size, rss in (
+      ('checkpoint', full_load, full_first, full_size, full_rss),
+      ('frozen', frozen_load, frozen_first, frozen_size, frozen_rss)):
+    tf.logging.info('%-12s %10.3f %12.3f %10.2f %10.1f', name, load, first,
+                    size / 2.0**20, rss)
+
+
+def main(unused_argv):
+  """Export the checkpoint in log_root and optionally benchmark it."""
+  export_path = FLAGS.export_path or os.path.join(
+      FLAGS.log_root, 'frozen_model.pb')
+  export_frozen_graph(FLAGS.log_root, export_path)
+  if FLAGS.benchmark:
+    benchmark(FLAGS.log_root, export_path)
+
+
+def console_entry_point():
+  tf.app.run(main)
+
+
+if __name__ == '__main__':
+  console_entry_point()
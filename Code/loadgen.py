@@ -0,0 +1,91 @@
+"""Load generator for the inference server in serve.py.
+
+Keeps a fixed number of keep-alive connections busy posting synthetic stroke-3
+sketches to /classify, then reports client side latency percentiles and
+throughput next to the server's own /stats.
+
+  python loadgen.py --port 8500 --concurrency 32 --requests 5000
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import synthetic
+
+
+async def request(reader, writer, method, path, payload=None):
+  """Send one HTTP/1.1 request on an open connection, return decoded JSON."""
+  body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+  writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\n'
+                'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                % (method, path, len(body))).encode('latin-1') + body)
+  await writer.drain()
+  await reader.readline()  # status line
+  length = 0
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b''):
+      break
+    name, value = line.decode('latin-1').split(':', 1)
+    if name.strip().lower() == 'content-length':
+      length = int(value)
+  return json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+
+async def client(host, port, sketches, latencies):
+  """Post every sketch in turn on one connection, recording latencies."""
+  reader, writer = await asyncio.open_connection(host, port)
+  try:
+    for sketch in sketches:
+      start = time.time()
+      await request(reader, writer, 'POST', '/classify', {'strokes': sketch})
+      latencies.append(time.time() - start)
+  finally:
+    writer.close()
+
+
+async def run(args):
+  rng = np.random.RandomState(args.seed)
+  sketches = [
+      synthetic.random_sketch(rng, args.min_len, args.max_len).tolist()
+      for _ in range(args.requests)]
+  latencies = []
+  start = time.time()
+  await asyncio.gather(*[
+      client(args.host, args.port, sketches[i::args.concurrency], latencies)
+      for i in range(args.concurrency)])
+  elapsed = time.time() - start
+  latencies = np.array(latencies) * 1000
+  print('requests: %d, concurrency: %d, elapsed: %.2fs' % (
+      len(latencies), args.concurrency, elapsed))
+  print('throughput: %.1f sketches/s' % (len(latencies) / elapsed))
+  print('latency p50: %.2fms, p99: %.2fms' % (
+      np.percentile(latencies, 50), np.percentile(latencies, 99)))
+  reader, writer = await asyncio.open_connection(args.host, args.port)
+  print('server stats:', await request(reader, writer, 'GET', '/stats'))
+  writer.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8500)
+  parser.add_argument('--concurrency', type=int, default=32,
+                      help='number of connections with a request in flight')
+  parser.add_argument('--requests', type=int, default=2000)
+  parser.add_argument('--min_len', type=int, default=10)
+  parser.add_argument('--max_len', type=int, default=120)
+  parser.add_argument('--seed', type=int, default=0)
+  asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+  main()
@@ -23,6 +23,7 @@ import random
 from magenta.models.sketch_rnn import rnn
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.ops import resource_variable_ops
 
 
 def copy_hparams(hparams):
@@ -40,15 +41,18 @@ def get_default_hparams():
       num_steps=10000,  # Total number of steps of training. Keep large.
       save_every=50,  # Number of batches per checkpoint creation.
       max_seq_len=250,  # Not used. Will be changed by model. [Eliminate?]
+      num_buckets=10,  # Length buckets for batching. 1 pads to max_seq_len.
+      sample_with_replacement=False,  # Draw batches independently, not by epoch.
       dec_rnn_size=512,  # Size of decoder.
       dec_model='lstm',  # Decoder: lstm, layer_norm or hyper.
       enc_rnn_size=256,  # Size of encoder.
-      enc_model='lstm',  # Encoder: lstm, layer_norm or hyper.
+      enc_model='lstm',  # Encoder: lstm, layer_norm, hyper or lstm_fused.
       z_size=128,  # Size of latent vector z. Recommend 32, 64 or 128.
       kl_weight=0.5,  # KL weight of loss equation. Recommend 0.5 or 1.0.
       kl_weight_start=0.01,  # KL start weight when annealing.
       kl_tolerance=0.2,  # Level of KL loss at which to stop optimizing for KL.
       batch_size=100,  # Minibatch size. Recommend leaving at 100.
+      eval_batch_size=500,  # Minibatch size for validation and test.
       grad_clip=1.0,  # Gradient clipping. Recommend leaving at 1.0.
       num_mixture=20,  # Number of mixtures in Gaussian mixture model.
       learning_rate=0.001,  # Learning rate.
@@ -71,18 +75,119 @@ def get_default_hparams():
   return hparams
 
 
+def decayed_learning_rate(hps, global_step):
+  """Return the learning rate tensor for global_step, decayed per minibatch."""
+  step = tf.cast(global_step, tf.float32)
+  return ((hps.learning_rate - hps.min_learning_rate) *
+          tf.pow(hps.decay_rate, step) + hps.min_learning_rate)
+
+
+def multi_step_train_op(model, next_batch, num_steps):
+  """Run num_steps training steps of model in one op.
+
+  A tf.while_loop applies one step body num_steps times, so the graph is
+  the same size for any num_steps. Every iteration pulls its own batch from
+  next_batch, updates the learning rate and applies the model's optimizer,
+  and only starts once the previous iteration's step has been applied, so
+  a single sess.run trains num_steps minibatches.
+
+  The variables must be resource variables (build the model under
+  tf.variable_scope(..., use_resource=True)): they are read anew wherever
+  an iteration uses them, after the previous step, where a reference
+  variable is read once per sess.run through its snapshot.
+
+  Args:
+    model: the training Model whose variables and optimizer are reused.
+    next_batch: a callable returning (input_data, sequence_lengths, y_labels)
+      tensors, such as the get_next method of a tf.data iterator.
+    num_steps: number of optimizer steps per run.
+
+  Returns:
+    The op running all the steps, the mean cost of the steps and the
+    learning rate of the last one.
+
+  Raises:
+    ValueError: if a model variable is a reference variable.
+  """
+  if not all(resource_variable_ops.is_resource_variable(var)
+             for var in tf.global_variables()):
+    raise ValueError('multi_step_train_op needs the model built with '
+                     'resource variables.')
+  hps = copy_hparams(model.hps)
+  hps.is_training = 0  # the step model shares the training variables.
+
+  def step_body(step, cost_sum, unused_lr):
+    # everything the step reads waits for the previous step to be applied.
+    with tf.control_dependencies([step]):
+      inputs = next_batch()
+      lr_update = tf.identity(tf.assign(
+          model.lr,
+          decayed_learning_rate(hps, model.global_step.read_value())))
+      step_model = Model(hps, reuse=True, inputs=inputs)
+      step_op = model.apply_step(step_model.ce_loss, lr_update)
+    with tf.control_dependencies([step_op]):
+      return (step + 1, cost_sum + step_model.ce_loss,
+              tf.identity(lr_update))
+
+  _, cost_sum, lr = tf.while_loop(
+      lambda step, unused_cost_sum, unused_lr: step < num_steps, step_body,
+      [tf.constant(0), tf.constant(0.0), tf.constant(0.0)],
+      parallel_iterations=1, back_prop=False)
+  return tf.group(cost_sum, lr), cost_sum / num_steps, lr
+
+
+def data_parallel_train_op(model, num_replicas):
+  """Build a synchronous data parallel training step over model replicas.
+
+  The model itself is replica 0 and num_replicas - 1 more replicas sharing
+  its variables are placed on /cpu:1, /cpu:2 and so on, so the session needs
+  that many CPU devices (see ConfigProto.device_count). Each replica is fed
+  its own batch through its own placeholders; the gradients of all of them
+  are averaged and go through a single clipped Adam step of the model.
+
+  Args:
+    model: the training Model whose variables and optimizer are reused.
+    num_replicas: total number of replicas, including model.
+
+  Returns:
+    The list of replica Models, the training op, the mean cost of the
+    replicas and the learning rate of the step.
+  """
+  hps = copy_hparams(model.hps)
+  hps.is_training = 0  # the replicas share the training variables.
+  replicas = [model]
+  for i in range(1, num_replicas):
+    with tf.device('/cpu:%d' % i):
+      replicas.append(Model(hps, reuse=True))
+  replica_gvs = [
+      model.optimizer.compute_gradients(
+          replica.ce_loss, colocate_gradients_with_ops=True)
+      for replica in replicas]
+  averaged_gvs = []
+  for pairs in zip(*replica_gvs):
+    grads = [grad for grad, _ in pairs if grad is not None]
+    if grads:
+      averaged_gvs.append((tf.add_n(grads) / len(grads), pairs[0][1]))
+  train_op = model.apply_gradients(averaged_gvs, model.lr_update)
+  cost = tf.add_n([replica.ce_loss for replica in replicas]) / num_replicas
+  return replicas, train_op, cost, model.lr_update
+
+
 class Model(object):
   """Define a SketchRNN model."""
 
-  def __init__(self, hps, gpu_mode=True, reuse=False):
+  def __init__(self, hps, gpu_mode=True, reuse=False, inputs=None):
     """Initializer for the SketchRNN model.
 
     Args:
        hps: a HParams object containing model hyperparameters
        gpu_mode: a boolean that when True, uses GPU mode.
        reuse: a boolean that when true, attemps to reuse variables.
+       inputs: optional (input_data, sequence_lengths, y_labels) tensors, e.g.
+         from a tf.data iterator, used in place of the placeholders.
     """
     self.hps = hps
+    self.inputs = inputs
     with tf.variable_scope('vector_rnn', reuse=reuse):
       if not gpu_mode:
         with tf.device('/cpu:0'):
@@ -94,6 +199,8 @@ class Model(object):
 
   def encoder(self, batch, sequence_lengths):
     """Define the bi-directional encoder module of sketch-rnn."""
+    if self.hps.enc_model == 'lstm_fused':
+      return self.fused_encoder(batch, sequence_lengths)
     unused_outputs, last_states = tf.nn.bidirectional_dynamic_rnn(
         self.enc_cell_fw,
         self.enc_cell_bw,
@@ -112,6 +219,33 @@ class Model(object):
     # and just returning last_h
     return last_h
 
+  def fused_encoder(self, batch, sequence_lengths):
+    """Bi-directional encoder running each direction as one fused LSTM op.
+
+    Without dropout, computes the same function as the 'lstm' encoder:
+    kernel is W_xh stacked on W_hh, the gates come in the same i, j, f, o
+    order and the forget bias is 1.0, so 'lstm' checkpoints convert with
+    convert_checkpoint.py. The fused kernel has no per-step hook for
+    recurrent dropout, so with use_recurrent_dropout the dropout is applied
+    to the final states instead.
+    """
+    with tf.variable_scope('ENC_RNN'):
+      time_major = tf.transpose(batch, [1, 0, 2])
+      _, (_, last_h_fw) = self.enc_cell_fw(
+          time_major, dtype=tf.float32, sequence_length=sequence_lengths,
+          scope='fw')
+      # like bidirectional_dynamic_rnn, the backward direction reads every
+      # sketch from its own last point, not from the padding.
+      reversed_batch = tf.reverse_sequence(
+          time_major, sequence_lengths, seq_axis=0, batch_axis=1)
+      _, (_, last_h_bw) = self.enc_cell_bw(
+          reversed_batch, dtype=tf.float32, sequence_length=sequence_lengths,
+          scope='bw')
+    last_h = tf.concat([last_h_fw, last_h_bw], 1)
+    if self.hps.use_recurrent_dropout:
+      last_h = tf.nn.dropout(last_h, self.hps.recurrent_dropout_prob)
+    return last_h
+
   def build_model(self, hps):
     """Define model architecture."""
     if hps.is_training:
@@ -123,6 +257,8 @@ class Model(object):
       enc_cell_fn = rnn.LayerNormLSTMCell
     elif hps.enc_model == 'hyper':
       enc_cell_fn = rnn.HyperLSTMCell
+    elif hps.enc_model == 'lstm_fused':
+      enc_cell_fn = tf.contrib.rnn.LSTMBlockFusedCell
     else:
       assert False, 'please choose a respectable cell'
 
@@ -131,7 +267,13 @@ class Model(object):
     use_output_dropout = self.hps.use_output_dropout
 
     if hps.conditional:  # vae mode:
-      if hps.enc_model == 'hyper':
+      if hps.enc_model == 'lstm_fused':
+        reuse = tf.get_variable_scope().reuse
+        self.enc_cell_fw = enc_cell_fn(
+            hps.enc_rnn_size, forget_bias=1.0, reuse=reuse)
+        self.enc_cell_bw = enc_cell_fn(
+            hps.enc_rnn_size, forget_bias=1.0, reuse=reuse)
+      elif hps.enc_model == 'hyper':
         self.enc_cell_fw = enc_cell_fn(
             hps.enc_rnn_size,
             use_recurrent_dropout=use_recurrent_dropout,
@@ -150,18 +292,29 @@ class Model(object):
             use_recurrent_dropout=use_recurrent_dropout,
             dropout_keep_prob=self.hps.recurrent_dropout_prob)
 
-    self.sequence_lengths = tf.placeholder(dtype=tf.int32, shape=[self.hps.batch_size])
-    self.input_data = tf.placeholder(dtype=tf.float32, shape=[self.hps.batch_size, self.hps.max_seq_len + 1, 5])
-    self.y_labels = tf.placeholder(dtype=tf.int32, shape=[self.hps.batch_size])
+    # The batch and time dimensions are left open, so one graph serves
+    # training, large batch evaluation and single sketch inference, and each
+    # batch is only padded to the length of its own bucket.
+    if self.inputs is not None:
+      self.input_data, self.sequence_lengths, self.y_labels = self.inputs
+    else:
+      self.sequence_lengths = tf.placeholder(
+          dtype=tf.int32, shape=[None], name='sequence_lengths')
+      self.input_data = tf.placeholder(
+          dtype=tf.float32, shape=[None, None, 5], name='input_data')
+      self.y_labels = tf.placeholder(
+          dtype=tf.int32, shape=[None], name='y_labels')
     print("self.y_labels.shape = ",self.y_labels.shape)
     # The target/expected vectors of strokes
-    self.output_x = self.input_data[:, 1:self.hps.max_seq_len + 1, :]
+    self.output_x = self.input_data[:, 1:, :]
     
     # either do vae-bit and get z, or do unconditional, decoder-only
     if hps.conditional:  # vae mode:
       self.batch_z = self.encoder(self.output_x, self.sequence_lengths)
     else:  # unconditional, decoder-only generation
-      self.batch_z = tf.zeros((self.hps.batch_size, self.hps.z_size), dtype=tf.float32)
+      self.batch_z = tf.zeros(
+          tf.stack([tf.shape(self.input_data)[0], self.hps.z_size]),
+          dtype=tf.float32)
 
 
     # TODO(deck): Better understand this comment.
@@ -174,7 +327,7 @@ class Model(object):
       output_w = tf.get_variable('output_w', [2*self.hps.enc_rnn_size, n_out])
       output_b = tf.get_variable('output_b', [n_out])
 
-    output = tf.nn.xw_plus_b(self.batch_z, output_w, output_b)
+    output = tf.nn.xw_plus_b(self.batch_z, output_w, output_b, name='output')
     self.output = output
     if self.y_labels is not None:
       self.ce_loss = self.lossfunctions(self.hps.loss_function)
@@ -182,14 +335,28 @@ class Model(object):
       self.ce_loss = 0
     if self.hps.is_training:
       self.lr = tf.Variable(self.hps.learning_rate, trainable=False)
-      optimizer = tf.train.AdamOptimizer(self.lr)
+      self.optimizer = tf.train.AdamOptimizer(self.lr)
 
       self.cost = self.ce_loss
 
-      gvs = optimizer.compute_gradients(self.cost)
-      g = self.hps.grad_clip
-      capped_gvs = [(tf.clip_by_value(grad, -g, g), var) for grad, var in gvs]
-      self.train_op = optimizer.apply_gradients(capped_gvs, global_step=self.global_step, name='train_step')
+      # the decayed learning rate is assigned in graph before every step.
+      self.lr_update = tf.identity(tf.assign(
+          self.lr, decayed_learning_rate(self.hps, self.global_step)))
+      self.train_op = self.apply_step(self.cost, self.lr_update)
+
+  def apply_step(self, cost, lr_update):
+    """Return an op taking one clipped Adam step on cost after lr_update."""
+    return self.apply_gradients(self.optimizer.compute_gradients(cost),
+                                lr_update)
+
+  def apply_gradients(self, gvs, lr_update):
+    """Return an op applying clipped (gradient, variable) pairs with Adam."""
+    g = self.hps.grad_clip
+    capped_gvs = [(tf.clip_by_value(grad, -g, g), var)
+                  for grad, var in gvs if grad is not None]
+    with tf.control_dependencies([lr_update]):
+      return self.optimizer.apply_gradients(
+          capped_gvs, global_step=self.global_step, name='train_step')
 
   def lossfunctions(self, lossfn):
     if lossfn == 'softmax':
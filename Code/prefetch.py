@@ -0,0 +1,109 @@
+"""Background batch prefetching for SketchRNN training."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+from concurrent import futures
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import utils_class as utils
+
+# DataLoader inherited by each worker process of a process pool.
+_worker_data_set = None
+
+
+def _init_worker(data_set):
+  """Hand the DataLoader to a worker process and give it its own seed."""
+  global _worker_data_set
+  _worker_data_set = data_set
+  np.random.seed((os.getpid() * 7919 + int(time.time() * 1000)) % (2**32))
+
+
+def _build_batch(indices, max_len):
+  """Build one batch inside a worker process."""
+  return _worker_data_set._get_batch_from_indices(indices, max_len)
+
+
+class BatchPrefetcher(object):
+  """Keeps a bounded queue of augmented, padded training batches in flight.
+
+  Batch indices are drawn from the DataLoader's sampler on the caller's
+  thread, so the batch order is the same as with random_batch. Building the
+  batches (gather, augmentation and stroke-5 padding) runs on a thread or
+  process pool, queue_size batches ahead of the consumer.
+  """
+
+  def __init__(self, data_set, queue_size=4, num_workers=1,
+               use_processes=False):
+    """Initializer for the prefetcher.
+
+    Args:
+      data_set: the DataLoader to draw random batches from.
+      queue_size: number of batches kept ready or in progress.
+      num_workers: size of the thread or process pool.
+      use_processes: if True, build batches in forked worker processes,
+        which sidesteps the GIL at the cost of copying each batch back.
+    """
+    self.data_set = data_set
+    self.queue_size = queue_size
+    self.use_processes = use_processes
+    if use_processes:
+      self._pool = futures.ProcessPoolExecutor(
+          num_workers, mp_context=multiprocessing.get_context('fork'),
+          initializer=_init_worker, initargs=(data_set,))
+      self._buffer = None
+    else:
+      self._pool = futures.ThreadPoolExecutor(num_workers)
+      # every queued batch and the one being fed need their own buffer.
+      self._buffer = utils.Stroke5Buffer(
+          data_set.batch_size, data_set.max_seq_length, queue_size + 2)
+    self._queue = collections.deque()
+    self._stall_time = 0.0
+    self._depth_total = 0
+    self._num_batches = 0
+    for _ in range(queue_size):
+      self._submit()
+
+  def _submit(self):
+    """Queue up the construction of the next random batch."""
+    idx, max_len = self.data_set.random_indices()
+    if self.use_processes:
+      future = self._pool.submit(_build_batch, idx, max_len)
+    else:
+      out = self._buffer.get(len(idx), max_len)
+      future = self._pool.submit(
+          self.data_set._get_batch_from_indices, idx, max_len, out)
+    self._queue.append(future)
+
+  def next_batch(self):
+    """Return the next batch, in the same format as DataLoader.random_batch."""
+    self._depth_total += sum(1 for f in self._queue if f.done())
+    self._num_batches += 1
+    future = self._queue.popleft()
+    start = time.time()
+    batch = future.result()
+    self._stall_time += time.time() - start
+    self._submit()
+    return batch
+
+  def pop_stats(self):
+    """Return (mean ready queue depth, consumer stall seconds) and reset."""
+    depth = self._depth_total / max(self._num_batches, 1)
+    stats = (depth, self._stall_time)
+    self._stall_time = 0.0
+    self._depth_total = 0
+    self._num_batches = 0
+    return stats
+
+  def close(self):
+    """Drop the pending batches and shut the pool down."""
+    for future in self._queue:
+      future.cancel()
+    self._queue.clear()
+    self._pool.shutdown(wait=True)
@@ -0,0 +1,155 @@
+"""Per-phase timers and step trace capture for the training loop.
+
+  profiler = profiling.Profiler(enabled=True, trace_steps=(100, 105),
+                                trace_dir=log_root)
+  with profiler.phase('batch'):
+    batch = train_set.random_batch()
+  options, run_metadata = profiler.trace_options(step)
+  sess.run(train_op, feed, options=options, run_metadata=run_metadata)
+  profiler.write_trace(step, run_metadata, summary_writer)
+
+Every phase keeps its last window durations, exported as TensorBoard
+histograms by summary(). Phases may nest: 'batch' includes the 'augment'
+and 'pad' phases the DataLoader records while building the batch. When the
+profiler is disabled, phase() hands out one shared no-op context manager.
+
+TensorFlow is only imported by the methods that export summaries and
+traces, so the numpy data layer can use the phase timers without it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import os
+import time
+
+import numpy as np
+
+# returned by phase() when profiling is off, so timing costs one call.
+NULL_PHASE = contextlib.nullcontext()
+
+
+class _Phase(object):
+  """Context manager recording its duration under a phase name."""
+
+  __slots__ = ('_profiler', '_name', '_start')
+
+  def __init__(self, profiler, name):
+    self._profiler = profiler
+    self._name = name
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self._profiler.record(self._name, time.perf_counter() - self._start)
+
+
+def parse_trace_steps(value):
+  """Parse 'N:M' (or 'N') into an inclusive (first, last) step range."""
+  if not value:
+    return None
+  first, _, last = value.partition(':')
+  return int(first), int(last or first)
+
+
+class Profiler(object):
+  """Named phase timers with rolling histograms and Chrome step traces."""
+
+  def __init__(self, enabled=True, window=1000, trace_steps=None,
+               trace_dir=None):
+    """Initializer for the profiler.
+
+    Args:
+      enabled: if False, phase() and record() do nothing.
+      window: number of most recent durations kept per phase.
+      trace_steps: optional inclusive (first, last) range of global steps
+        to capture a full TensorFlow trace of, independent of enabled.
+      trace_dir: directory the Chrome trace files are written to.
+    """
+    self.enabled = enabled
+    self.window = window
+    self.trace_steps = trace_steps
+    self.trace_dir = trace_dir
+    self._durations = collections.defaultdict(
+        lambda: collections.deque(maxlen=window))
+
+  def phase(self, name):
+    """Return a context manager timing one occurrence of phase name."""
+    if not self.enabled:
+      return NULL_PHASE
+    return _Phase(self, name)
+
+  def record(self, name, seconds):
+    """Add one duration of phase name; safe to call from worker threads."""
+    if self.enabled:
+      self._durations[name].append(seconds)
+
+  def means(self):
+    """Return {phase: mean seconds} over the rolling window."""
+    return {name: float(np.mean(values))
+            for name, values in self._durations.items() if values}
+
+  def summary(self):
+    """Return a tf.Summary with a histogram and mean per phase."""
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
+    summ = tf.summary.Summary()
+    for name, values in sorted(self._durations.items()):
+      if not values:
+        continue
+      values = np.array(values) * 1000.0
+      counts, edges = np.histogram(values, bins=30)
+      histo = tf.HistogramProto(
+          min=float(values.min()), max=float(values.max()),
+          num=len(values), sum=float(values.sum()),
+          sum_squares=float(np.dot(values, values)))
+      histo.bucket_limit.extend(edges[1:].tolist())
+      histo.bucket.extend(counts.tolist())
+      summ.value.add(tag='Phase_ms/' + name, histo=histo)
+      summ.value.add(tag='Phase_mean_ms/' + name,
+                     simple_value=float(values.mean()))
+    return summ
+
+  def log_means(self):
+    """Log the mean duration of every phase in milliseconds."""
+    means = self.means()
+    if means:
+      import tensorflow as tf  # pylint: disable=g-import-not-at-top
+      tf.logging.info('phases (mean ms): %s', ', '.join(
+          '%s %.3f' % (name, means[name] * 1000.0) for name in sorted(means)))
+
+  def tracing(self, step, num_steps=1):
+    """Whether a run of steps step .. step + num_steps - 1 is traced."""
+    if self.trace_steps is None:
+      return False
+    first, last = self.trace_steps
+    return step <= last and step + num_steps - 1 >= first
+
+  def trace_options(self, step, num_steps=1):
+    """Return (options, run_metadata) for sess.run, both None if untraced."""
+    if not self.tracing(step, num_steps):
+      return None, None
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
+    return (tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            tf.RunMetadata())
+
+  def write_trace(self, step, run_metadata, summary_writer=None):
+    """Write the Chrome trace of a traced run, a no-op for untraced ones."""
+    if run_metadata is None:
+      return
+    # pylint: disable=g-import-not-at-top
+    import tensorflow as tf
+    from tensorflow.python.client import timeline
+    # pylint: enable=g-import-not-at-top
+    path = os.path.join(self.trace_dir, 'timeline_step_%d.json' % step)
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with tf.gfile.Open(path, 'w') as f:
+      f.write(trace.generate_chrome_trace_format())
+    if summary_writer is not None:
+      summary_writer.add_run_metadata(run_metadata, 'step_%d' % step, step)
+    tf.logging.info('Wrote step trace %s, open it in chrome://tracing.', path)
@@ -0,0 +1,169 @@
+"""Post-training int8 quantization of the CNN classifier trained by cnn.py.
+
+Converts the saved Keras model into a full-integer TensorFlow Lite model:
+weights and activations are int8, calibrated on QuickDraw bitmaps from the
+training split, and the model takes and returns uint8 tensors, so raw 0-255
+pixels can be fed without converting them to float. A float TensorFlow Lite
+model is converted alongside it, and both are compared on the test split of
+cnn.split_data for accuracy, file size and per-image latency.
+
+  python cnn.py
+  python quantize.py --model_path ./cnn_model.h5 --output_dir ./tflite
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import cnn
+
+
+def representative_dataset(images, num_samples=500, seed=0):
+  """Return a generator of single image calibration batches from images."""
+  rng = np.random.RandomState(seed)
+  idx = rng.choice(len(images), min(num_samples, len(images)), replace=False)
+
+  def generator():
+    for i in idx:
+      yield [cnn.normalize(images[i:i + 1])]
+  return generator
+
+
+def convert(model_path, output_path, calibration_images=None,
+            num_samples=500):
+  """Convert a saved Keras model to TensorFlow Lite and return its size.
+
+  Without calibration_images the model stays float. With them, weights and
+  activations are quantized to int8 using their value ranges on num_samples
+  of those images, only int8 kernels are allowed and the input and output
+  become uint8.
+  """
+  converter = tf.lite.TFLiteConverter.from_keras_model_file(model_path)
+  if calibration_images is not None:
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset(
+        calibration_images, num_samples)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.uint8
+    converter.inference_output_type = tf.uint8
+  flatbuffer = converter.convert()
+  with open(output_path, 'wb') as f:
+    f.write(flatbuffer)
+  return len(flatbuffer)
+
+
+class TFLiteClassifier(object):
+  """Batched CPU inference with a float or quantized TensorFlow Lite model.
+
+  predict takes uint8 images like cnn.split_data returns, or images already
+  normalized to [0, 1]. They are normalized and, when the model input is an
+  integer tensor, quantized one batch at a time.
+  """
+
+  def __init__(self, model_path, batch_size=256):
+    self.interpreter = tf.lite.Interpreter(model_path=model_path)
+    self.batch_size = batch_size
+    self._input = self.interpreter.get_input_details()[0]
+    self._output = self.interpreter.get_output_details()[0]
+    self._resize(batch_size)
+
+  def _resize(self, batch_size):
+    """Resize the input to hold batch_size images and reallocate."""
+    shape = [batch_size] + list(self._input['shape'][1:])
+    self.interpreter.resize_tensor_input(self._input['index'], shape)
+    self.interpreter.allocate_tensors()
+    self._batch = batch_size
+
+  def _quantize(self, images):
+    """Map images to the dtype and scale of the model input."""
+    if images.dtype == np.uint8:
+      images = cnn.normalize(images)
+    dtype = self._input['dtype']
+    if dtype == np.float32:
+      return images.astype(np.float32)
+    scale, zero_point = self._input['quantization']
+    info = np.iinfo(dtype)
+    q = np.round(images / scale + zero_point)
+    return np.clip(q, info.min, info.max).astype(dtype)
+
+  def _dequantize(self, output):
+    """Map the model output back to float probabilities."""
+    if self._output['dtype'] == np.float32:
+      return output
+    scale, zero_point = self._output['quantization']
+    return (output.astype(np.float32) - zero_point) * scale
+
+  def predict(self, images):
+    """Return the class probabilities of images, one row per image."""
+    outputs = []
+    for start in range(0, len(images), self.batch_size):
+      batch = self._quantize(images[start:start + self.batch_size])
+      if len(batch) != self._batch:
+        self._resize(len(batch))
+      self.interpreter.set_tensor(self._input['index'], batch)
+      self.interpreter.invoke()
+      outputs.append(self._dequantize(
+          self.interpreter.get_tensor(self._output['index'])))
+    if self._batch != self.batch_size:
+      self._resize(self.batch_size)
+    return np.concatenate(outputs)
+
+
+def evaluate(classifier, images, labels):
+  """Return (accuracy, milliseconds per image) of classifier on images."""
+  classifier.predict(images[:classifier.batch_size])  # warm up
+  start = time.time()
+  probabilities = classifier.predict(images)
+  latency = (time.time() - start) * 1000.0 / len(images)
+  accuracy = np.mean(np.argmax(probabilities, axis=1) == labels)
+  return accuracy, latency
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--model_path', default=cnn.model_path)
+  parser.add_argument('--data_dir', default='.')
+  parser.add_argument('--output_dir', default='.')
+  parser.add_argument('--calibration_samples', type=int, default=500)
+  parser.add_argument('--batch_size', type=int, default=256)
+  args = parser.parse_args()
+
+  input, labels = cnn.load_bitmaps(args.data_dir)
+  x_train, x_test, _, y_test = cnn.split_data(input, labels)
+
+  float_path = os.path.join(args.output_dir, 'cnn_float.tflite')
+  int8_path = os.path.join(args.output_dir, 'cnn_int8.tflite')
+  results = {}
+  for name, path, images in (('float', float_path, None),
+                             ('int8', int8_path, x_train)):
+    size = convert(args.model_path, path, images, args.calibration_samples)
+    accuracy, latency = evaluate(
+        TFLiteClassifier(path, args.batch_size), x_test, y_test)
+    results[name] = (accuracy, size, latency)
+
+  keras_model = tf.keras.models.load_model(args.model_path, compile=False)
+  keras_accuracy = np.mean(np.argmax(
+      keras_model.predict(cnn.normalize(x_test), batch_size=args.batch_size),
+      axis=1) == y_test)
+  print('keras float32 test accuracy: %.2f%%' % (keras_accuracy * 100))
+  print('%-8s %10s %10s %12s' % ('model', 'accuracy', 'size_KB',
+                                 'ms_per_image'))
+  for name in ('float', 'int8'):
+    accuracy, size, latency = results[name]
+    print('%-8s %9.2f%% %10.1f %12.4f' % (name, accuracy * 100,
+                                           size / 1024.0, latency))
+  print('int8 accuracy drop: %.2f points, %.1fx smaller, %.2fx faster' % (
+      (results['float'][0] - results['int8'][0]) * 100,
+      results['float'][1] / float(results['int8'][1]),
+      results['float'][2] / results['int8'][2]))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,96 @@
+"""Measure how synchronous data parallel training scales with replicas.
+
+Times the training step of sketch_rnn.py --num_replicas for 1 up to
+max_replicas replicas on the dataset in data_dir, and logs throughput,
+speedup and parallel efficiency. Every replica trains on batch_size
+sketches, so the work per step grows with the number of replicas.
+
+  python scaling_benchmark.py --data_dir=... --max_replicas=8
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+import tensorflow as tf
+
+import model as sketch_rnn_model
+import sketch_rnn
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_integer(
+    'max_replicas', os.cpu_count() or 1,
+    'Largest number of replicas to benchmark.')
+tf.app.flags.DEFINE_integer(
+    'benchmark_steps', 50, 'Number of timed training steps per replica count.')
+tf.app.flags.DEFINE_integer(
+    'warmup_steps', 5, 'Number of untimed training steps run first.')
+
+
+def time_replicas(model_params, train_set, num_replicas, num_steps,
+                  warmup_steps=5):
+  """Return the mean seconds per synchronous step with num_replicas."""
+  sketch_rnn.reset_graph()
+  model = sketch_rnn_model.Model(model_params)
+  replicas, train_op, _, _ = sketch_rnn_model.data_parallel_train_op(
+      model, num_replicas)
+  if num_replicas > 1:
+    shards = [train_set.shard(i, num_replicas) for i in range(num_replicas)]
+  else:
+    shards = [train_set]
+  with tf.Session(config=sketch_rnn.session_config(num_replicas)) as sess:
+    sess.run(tf.global_variables_initializer())
+    for i in range(warmup_steps + num_steps):
+      if i == warmup_steps:
+        start = time.time()
+      feed = {}
+      for replica, shard in zip(replicas, shards):
+        _, lab, x, s = shard.random_batch()
+        feed.update({
+            replica.input_data: x,
+            replica.y_labels: lab,
+            replica.sequence_lengths: s,
+        })
+      sess.run(train_op, feed)
+    return (time.time() - start) / num_steps
+
+
+def main(unused_argv):
+  """Benchmark 1 to max_replicas replicas and log the scaling table."""
+  model_params = sketch_rnn_model.get_default_hparams()
+  if FLAGS.hparams:
+    model_params.parse(FLAGS.hparams)
+  datasets = sketch_rnn.load_dataset(FLAGS.data_dir, model_params,
+                                     cache_dir=FLAGS.dataset_cache_dir,
+                                     num_workers=FLAGS.load_workers,
+                                     use_processes=FLAGS.load_processes,
+                                     download_dir=FLAGS.download_cache_dir)
+  train_set, model_params = datasets[0], datasets[3]
+
+  results = []
+  for num_replicas in range(1, FLAGS.max_replicas + 1):
+    step_time = time_replicas(model_params, train_set, num_replicas,
+                              FLAGS.benchmark_steps, FLAGS.warmup_steps)
+    results.append((num_replicas, step_time))
+    tf.logging.info('replicas: %i, step_time: %.4fs', num_replicas, step_time)
+
+  base_throughput = model_params.batch_size / results[0][1]
+  tf.logging.info('%-8s %10s %14s %8s %10s', 'replicas', 'step_s',
+                  'sketches_s', 'speedup', 'efficiency')
+  for num_replicas, step_time in results:
+    throughput = num_replicas * model_params.batch_size / step_time
+    speedup = throughput / base_throughput
+    tf.logging.info('%-8i %10.4f %14.1f %8.2f %10.2f', num_replicas,
+                    step_time, throughput, speedup, speedup / num_replicas)
+
+
+def console_entry_point():
+  tf.app.run(main)
+
+
+if __name__ == '__main__':
+  console_entry_point()
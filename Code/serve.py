@@ -0,0 +1,242 @@
+"""Micro-batching inference server for the SketchRNN classifier.
+
+Serves a checkpoint written by sketch_rnn.py over HTTP:
+
+  POST /classify  {"strokes": [[dx, dy, pen_lift], ...]}
+                  -> {"class": 3, "label": "sketchrnn_airplane.npz",
+                      "logits": [...]}
+  GET  /stats     -> latency percentiles, throughput and mean batch size.
+
+Concurrent requests are grouped into micro-batches of at most max_batch_size
+sketches, waiting no longer than max_latency_ms after the first one arrives,
+and each micro-batch is run through the model on a single worker thread.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import collections
+from concurrent import futures
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import export
+import model as sketch_rnn_model
+import sketch_rnn
+import utils_class as utils
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string(
+    'host', '127.0.0.1', 'Address the inference server listens on.')
+tf.app.flags.DEFINE_integer(
+    'port', 8500, 'Port the inference server listens on.')
+tf.app.flags.DEFINE_integer(
+    'max_batch_size', 64, 'Largest number of sketches run in one micro-batch.')
+tf.app.flags.DEFINE_float(
+    'max_latency_ms', 5.0,
+    'Longest time the first sketch of a micro-batch waits for more to arrive.')
+tf.app.flags.DEFINE_string(
+    'frozen_model', '',
+    'Serve this graph written by export.py instead of the checkpoint in '
+    'log_root.')
+tf.app.flags.DEFINE_integer(
+    'stats_every', 10, 'Seconds between two latency and throughput reports.')
+
+
+class SketchClassifier(object):
+  """Restores a trained Model and classifies batches of stroke-3 sketches."""
+
+  def __init__(self, checkpoint_dir):
+    self.hps = sketch_rnn.load_model_params(checkpoint_dir, inference=True)
+    self.scale_factor, self.limit = sketch_rnn.load_normalization(
+        checkpoint_dir)
+    self.labels = list(self.hps.data_set)
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.model = sketch_rnn_model.Model(self.hps)
+      self.sess = tf.Session()
+      sketch_rnn.load_checkpoint(self.sess, checkpoint_dir)
+
+  def predict(self, sketches):
+    """Return the logits of a list of stroke-3 sketches."""
+    x, lengths = utils.normalize_and_pad(
+        sketches, self.scale_factor, self.limit)
+    feed = {self.model.input_data: x, self.model.sequence_lengths: lengths}
+    return self.sess.run(self.model.output, feed)
+
+
+class MicroBatcher(object):
+  """Groups concurrent classify calls into micro-batches for a classifier."""
+
+  def __init__(self, classifier, max_batch_size=64, max_latency=0.005,
+               history=10000):
+    self.classifier = classifier
+    self.max_batch_size = max_batch_size
+    self.max_latency = max_latency
+    self._queue = asyncio.Queue()
+    # sess.run happens on one worker thread so the event loop stays free.
+    self._executor = futures.ThreadPoolExecutor(1)
+    self._completed = collections.deque(maxlen=history)  # (time, latency)
+    self._batch_sizes = collections.deque(maxlen=history)
+
+  async def classify(self, sketch):
+    """Queue one sketch and return its logits once its micro-batch ran."""
+    future = asyncio.get_event_loop().create_future()
+    await self._queue.put((sketch, future, time.time()))
+    return await future
+
+  async def _next_batch(self):
+    """Wait for a first request, then gather more until full or timed out."""
+    items = [await self._queue.get()]
+    deadline = items[0][2] + self.max_latency
+    while len(items) < self.max_batch_size:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        if self._queue.empty():
+          break
+        items.append(self._queue.get_nowait())
+        continue
+      try:
+        items.append(await asyncio.wait_for(self._queue.get(), timeout))
+      except asyncio.TimeoutError:
+        break
+    return items
+
+  async def run(self):
+    """Serve micro-batches until cancelled."""
+    loop = asyncio.get_event_loop()
+    while True:
+      items = await self._next_batch()
+      sketches = [item[0] for item in items]
+      try:
+        logits = await loop.run_in_executor(
+            self._executor, self.classifier.predict, sketches)
+      except Exception as e:  # pylint: disable=broad-except
+        for _, future, _ in items:
+          if not future.done():
+            future.set_exception(e)
+        continue
+      now = time.time()
+      for (_, future, start), row in zip(items, logits):
+        if not future.done():
+          future.set_result(row)
+        self._completed.append((now, now - start))
+      self._batch_sizes.append(len(items))
+
+  def stats(self, window=10.0):
+    """Return latency percentiles and throughput over the last window secs."""
+    now = time.time()
+    latencies = np.array(
+        [latency for done, latency in self._completed if done >= now - window])
+    result = {'requests': len(latencies),
+              'throughput': len(latencies) / window,
+              'mean_batch_size': (float(np.mean(self._batch_sizes))
+                                  if self._batch_sizes else 0.0)}
+    if len(latencies):
+      result['p50_ms'] = float(np.percentile(latencies, 50) * 1000)
+      result['p99_ms'] = float(np.percentile(latencies, 99) * 1000)
+    return result
+
+
+async def classify_request(batcher, body):
+  """Handle a POST /classify body, returning (status, response payload)."""
+  try:
+    strokes = np.array(json.loads(body.decode('utf-8'))['strokes'],
+                       dtype=np.float32)
+  except (ValueError, KeyError, TypeError):
+    return 400, {'error': 'expected {"strokes": [[dx, dy, pen_lift], ...]}'}
+  if strokes.ndim != 2 or strokes.shape[1] != 3 or not len(strokes):
+    return 400, {'error': 'strokes must be a non-empty list of [dx, dy, p]'}
+  logits = await batcher.classify(strokes)
+  predicted = int(np.argmax(logits))
+  return 200, {'class': predicted,
+               'label': batcher.classifier.labels[predicted],
+               'logits': [float(v) for v in logits]}
+
+
+async def handle_connection(batcher, reader, writer):
+  """Serve HTTP/1.1 requests on one keep-alive connection."""
+  try:
+    while True:
+      request_line = await reader.readline()
+      if not request_line:
+        break
+      method, path = request_line.decode('latin-1').split()[:2]
+      headers = {}
+      while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+          break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+      body = await reader.readexactly(int(headers.get('content-length', 0)))
+      if method == 'POST' and path == '/classify':
+        status, payload = await classify_request(batcher, body)
+      elif method == 'GET' and path == '/stats':
+        status, payload = 200, batcher.stats()
+      else:
+        status, payload = 404, {'error': 'not found'}
+      data = json.dumps(payload).encode('utf-8')
+      writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                    'Content-Length: %d\r\n\r\n' % (
+                        status, 'OK' if status == 200 else 'Error',
+                        len(data))).encode('latin-1') + data)
+      await writer.drain()
+      if headers.get('connection', '').lower() == 'close':
+        break
+  except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+    pass
+  finally:
+    writer.close()
+
+
+async def log_stats(batcher, every):
+  """Periodically log latency percentiles and throughput."""
+  while True:
+    await asyncio.sleep(every)
+    stats = batcher.stats(window=every)
+    if stats['requests']:
+      tf.logging.info(
+          'requests: %i, throughput: %.1f/s, p50: %.2fms, p99: %.2fms, '
+          'mean_batch_size: %.1f', stats['requests'], stats['throughput'],
+          stats['p50_ms'], stats['p99_ms'], stats['mean_batch_size'])
+
+
+async def serve(classifier, host, port, max_batch_size, max_latency,
+                stats_every):
+  """Run the inference server until cancelled."""
+  batcher = MicroBatcher(classifier, max_batch_size, max_latency)
+  tasks = [asyncio.ensure_future(batcher.run()),
+           asyncio.ensure_future(log_stats(batcher, stats_every))]
+  server = await asyncio.start_server(
+      lambda r, w: handle_connection(batcher, r, w), host, port)
+  tf.logging.info('Serving on %s:%i.', host, port)
+  try:
+    await server.serve_forever()
+  finally:
+    for task in tasks:
+      task.cancel()
+
+
+def main(unused_argv):
+  """Restore the checkpoint in log_root, or the frozen model, and serve it."""
+  if FLAGS.frozen_model:
+    classifier = export.FrozenSketchClassifier(FLAGS.frozen_model)
+  else:
+    classifier = SketchClassifier(FLAGS.log_root)
+  asyncio.run(serve(classifier, FLAGS.host, FLAGS.port, FLAGS.max_batch_size,
+                    FLAGS.max_latency_ms / 1000.0, FLAGS.stats_every))
+
+
+def console_entry_point():
+  tf.app.run(main)
+
+
+if __name__ == '__main__':
+  console_entry_point()
@@ -17,7 +17,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from cStringIO import StringIO
+from concurrent import futures
 import json
 import os
 import time
@@ -26,11 +26,15 @@ import zipfile
 
 from IPython.core.debugger import set_trace
 import numpy as np
-import requests
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
+import checkpoint_manager
+import dataset_cache
+import download
 import model as sketch_rnn_model
+import prefetch
+import profiling
 import utils_class as utils
 tf.logging.set_verbosity(tf.logging.INFO)
 
@@ -42,18 +46,72 @@ tf.app.flags.DEFINE_string(
     # 'https://github.com/hardmaru/sketch-rnn-datasets/raw/master/',
     'The directory in which to find the dataset specified in model hparams. '
     'If data_dir starts with "http://" or "https://", the file will be fetched '
-    'remotely.')
+    'remotely into download_cache_dir.')
 tf.app.flags.DEFINE_string(
     'log_root', '/tmp/sketch_rnn/models/default',
     'Directory to store model checkpoints, tensorboard.')
+tf.app.flags.DEFINE_string(
+    'download_cache_dir', '/tmp/sketch_rnn/downloads',
+    'Directory where files fetched from a remote data_dir are kept, so they '
+    'are only downloaded again when the remote copy changes.')
+tf.app.flags.DEFINE_string(
+    'dataset_cache_dir', '/tmp/sketch_rnn/dataset_cache',
+    'Directory holding preprocessed datasets keyed by their source files and '
+    'preprocessing settings. Set to an empty string to disable the cache.')
+tf.app.flags.DEFINE_integer(
+    'load_workers', 8,
+    'Number of classes loaded in parallel by load_dataset.')
+tf.app.flags.DEFINE_boolean(
+    'load_processes', False,
+    'Set to true to load classes in worker processes instead of threads.')
 tf.app.flags.DEFINE_boolean(
     'resume_training', False,
     'Set to true to load previous checkpoint')
+tf.app.flags.DEFINE_integer(
+    'keep_last_checkpoints', 5,
+    'Number of most recent checkpoints kept in log_root.')
+tf.app.flags.DEFINE_integer(
+    'keep_best_checkpoints', 1,
+    'Number of checkpoints with the lowest validation cost kept in log_root.')
 tf.app.flags.DEFINE_string(
     'hparams', '',
     'Pass in comma-separated key=value pairs such as '
     '\'save_every=40,decay_rate=0.99\' '
     '(no whitespace) to be read into the HParams object defined in model.py')
+tf.app.flags.DEFINE_integer(
+    'prefetch_batches', 0,
+    'Number of training batches to build ahead of the training step on a '
+    'background pool. 0 builds each batch inline.')
+tf.app.flags.DEFINE_integer(
+    'prefetch_workers', 1,
+    'Number of threads or processes building prefetched batches.')
+tf.app.flags.DEFINE_boolean(
+    'prefetch_processes', False,
+    'Set to true to build prefetched batches in worker processes instead of '
+    'threads.')
+tf.app.flags.DEFINE_integer(
+    'in_graph_steps', 0,
+    'If > 0, feed training batches through an in-graph tf.data pipeline and '
+    'run this many optimizer steps per sess.run, in a tf.while_loop over one '
+    'step, with the model built from resource variables. 0 feeds every '
+    'step.')
+tf.app.flags.DEFINE_integer(
+    'num_replicas', 1,
+    'Number of synchronous data parallel model replicas, each on its own CPU '
+    'device and training on its own shard of the training set. The batch '
+    'size is per replica.')
+tf.app.flags.DEFINE_boolean(
+    'profile', False,
+    'Set to true to time the phases of every training step (batch, augment, '
+    'pad, feed, step, summaries, eval and checkpoint) and export their '
+    'histograms to TensorBoard.')
+tf.app.flags.DEFINE_integer(
+    'profile_window', 1000,
+    'Number of most recent durations kept per phase for the histograms.')
+tf.app.flags.DEFINE_string(
+    'trace_steps', '',
+    'Global steps N:M (inclusive) to capture a full TensorFlow trace of, '
+    'written to log_root as Chrome timelines. Empty traces nothing.')
 
 PRETRAINED_MODELS_URL = ('http://download.magenta.tensorflow.org/models/'
                          'sketch_rnn.zip')
@@ -71,7 +129,9 @@ def reset_graph():
     sess.close()
   tf.reset_default_graph()
 
-def load_dataset(data_dir, model_params, inference_mode=False):
+def load_dataset(data_dir, model_params, inference_mode=False,
+                 cache_dir=None, num_workers=8, use_processes=False,
+                 download_dir='/tmp/sketch_rnn/downloads'):
   """Loads the .npz file, and splits the set into train/valid/test."""
 
   # normalizes the x and y columns usint the training set.
@@ -83,48 +143,38 @@ def load_dataset(data_dir, model_params, inference_mode=False):
   else:
     datasets = [model_params.data_set]
 
-  train_strokes = None
-  valid_strokes = None
-  test_strokes = None
-  train_y = None
-  valid_y = None
-  test_y = None
-  for idx, dataset in enumerate(datasets):
-    data_filepath = os.path.join(data_dir, dataset)
-    if data_dir.startswith('http://') or data_dir.startswith('https://'):
-      tf.logging.info('Downloading %s', data_filepath)
-      response = requests.get(data_filepath)
-      data = np.load(StringIO(response.content))
-    else:
-      data = np.load(data_filepath)  # load this into dictionary
-    tf.logging.info('Loaded {}/{}/{} from {}'.format(
-        len(data['train']), len(data['valid']), len(data['test']),
-        dataset))
-    if train_strokes is None:
-      train_strokes = data['train']
-      valid_strokes = data['valid']
-      test_strokes = data['test']
-      train_y = [idx]*len(train_strokes)
-      valid_y = [idx]*len(valid_strokes)
-      test_y = [idx]*len(test_strokes)
-    else:
-      train_strokes = np.concatenate((train_strokes, data['train']))
-      valid_strokes = np.concatenate((valid_strokes, data['valid']))
-      test_strokes = np.concatenate((test_strokes, data['test']))
-      train_y = np.concatenate((train_y, [idx]*len(data['train'])))
-      valid_y = np.concatenate((valid_y, [idx]*len(data['valid'])))
-      test_y = np.concatenate((test_y, [idx]*len(data['test'])))
-  all_strokes = np.concatenate((train_strokes, valid_strokes, test_strokes))
-  num_points = 0
-  for stroke in all_strokes:
-    num_points += len(stroke)
-  avg_len = num_points / len(all_strokes)
-  tf.logging.info('Dataset combined: {} ({}/{}/{}), avg len {}'.format(
-      len(all_strokes), len(train_strokes), len(valid_strokes),
-      len(test_strokes), int(avg_len)))
+  if download.is_remote(data_dir):
+    data_dir = download.fetch_all(data_dir, datasets, download_dir,
+                                  num_workers=num_workers)
+
+  key = None
+  cached = None
+  if cache_dir:
+    key = dataset_cache.cache_key(
+        datasets, [os.path.join(data_dir, d) for d in datasets],
+        {'limit': 1000}, cache_dir)
+    cached = dataset_cache.load(cache_dir, key)
+
+  if cached is not None:
+    tf.logging.info('Mapped preprocessed dataset %s from %s.', key, cache_dir)
+    max_seq_len = cached['meta']['max_seq_len']
+    normalizing_scale_factor = cached['meta']['scale_factor']
+    train_strokes = utils.RaggedStrokes(*cached['train'][:2])
+    valid_strokes = utils.RaggedStrokes(*cached['valid'][:2])
+    test_strokes = utils.RaggedStrokes(*cached['test'][:2])
+    train_y = cached['train'][2]
+    valid_y = cached['valid'][2]
+    test_y = cached['test'][2]
+  else:
+    (train_strokes, valid_strokes, test_strokes, train_y, valid_y,
+     test_y, max_seq_len, train_moments) = load_strokes(
+         data_dir, datasets, num_workers=num_workers,
+         use_processes=use_processes)
+    # max_seq_len is the longest sketch of all splits, so no training sketch
+    # is dropped and the moments gathered while loading are the ones
+    # calculate_normalizing_scale_factor would compute.
+    normalizing_scale_factor = train_moments.std()
 
-  # calculate the max strokes we need.
-  max_seq_len = utils.get_max_len(all_strokes)
   # overwrite the hps with this calculation.
   model_params.max_seq_len = max_seq_len
 
@@ -136,6 +186,7 @@ def load_dataset(data_dir, model_params, inference_mode=False):
   eval_model_params.use_recurrent_dropout = 0
   eval_model_params.use_output_dropout = 0
   eval_model_params.is_training = 1
+  eval_model_params.batch_size = model_params.eval_batch_size
 
   if inference_mode:
     eval_model_params.batch_size = 1
@@ -144,34 +195,54 @@ def load_dataset(data_dir, model_params, inference_mode=False):
   sample_model_params = sketch_rnn_model.copy_hparams(eval_model_params)
   sample_model_params.batch_size = 1  # only sample one at a time
   sample_model_params.max_seq_len = 1  # sample one point at a time
-  
+
+  # cached splits are already normalized, so only record the factor.
+  loader_scale_factor = (
+      normalizing_scale_factor if cached is not None else 1.0)
+
   train_set = utils.DataLoader(
       strokes=train_strokes, labels=train_y,
       batch_size=model_params.batch_size,
       max_seq_length=model_params.max_seq_len,
+      scale_factor=loader_scale_factor,
       random_scale_factor=model_params.random_scale_factor,
-      augment_stroke_prob=model_params.augment_stroke_prob)
-
-  normalizing_scale_factor = train_set.calculate_normalizing_scale_factor()
-  train_set.normalize(normalizing_scale_factor)
+      augment_stroke_prob=model_params.augment_stroke_prob,
+      num_pad_buffers=2,
+      num_buckets=model_params.num_buckets,
+      sample_with_replacement=model_params.sample_with_replacement)
 
   valid_set = utils.DataLoader(
       strokes=valid_strokes,
       labels=valid_y,
       batch_size=eval_model_params.batch_size,
       max_seq_length=eval_model_params.max_seq_len,
+      scale_factor=loader_scale_factor,
       random_scale_factor=0.0,
-      augment_stroke_prob=0.0)
-  valid_set.normalize(normalizing_scale_factor)
+      augment_stroke_prob=0.0,
+      num_pad_buffers=2,
+      num_buckets=eval_model_params.num_buckets)
 
   test_set = utils.DataLoader(
       strokes=test_strokes,
       labels=test_y,
       batch_size=eval_model_params.batch_size,
       max_seq_length=eval_model_params.max_seq_len,
+      scale_factor=loader_scale_factor,
       random_scale_factor=0.0,
-      augment_stroke_prob=0.0)
-  test_set.normalize(normalizing_scale_factor)
+      augment_stroke_prob=0.0,
+      num_pad_buffers=2,
+      num_buckets=eval_model_params.num_buckets)
+
+  if cached is None:
+    train_set.normalize(normalizing_scale_factor)
+    valid_set.normalize(normalizing_scale_factor)
+    test_set.normalize(normalizing_scale_factor)
+    if key is not None:
+      dataset_cache.save(
+          cache_dir, key,
+          {'train': train_set, 'valid': valid_set, 'test': test_set},
+          {'max_seq_len': int(max_seq_len),
+           'scale_factor': float(normalizing_scale_factor)})
 
   tf.logging.info('normalizing_scale_factor %4.4f.', normalizing_scale_factor)
 
@@ -181,23 +252,119 @@ def load_dataset(data_dir, model_params, inference_mode=False):
   ]
   return result
 
+
+def load_class(data_dir, dataset, limit=1000):
+  """Loads one class .npz and summarizes it.
+
+  Returns:
+    A dict with the 'train', 'valid' and 'test' stroke arrays, the
+    'moments' of the clamped training offsets, the 'max_len' and
+    'num_points' over all splits, and the 'time' taken.
+  """
+  start = time.time()
+  data_filepath = os.path.join(data_dir, dataset)
+  data = np.load(data_filepath, encoding='latin1', allow_pickle=True)
+  result = {split: data[split] for split in ('train', 'valid', 'test')}
+  moments = utils.RunningMoments()
+  if len(result['train']):
+    class_points = np.concatenate(result['train'])[:, 0:2]
+    moments.update(np.clip(class_points, -limit, limit))
+  lengths = np.array([len(stroke) for split in ('train', 'valid', 'test')
+                      for stroke in result[split]], dtype=np.int64)
+  result['moments'] = moments
+  result['max_len'] = int(lengths.max()) if len(lengths) else 0
+  result['num_points'] = int(lengths.sum())
+  result['time'] = time.time() - start
+  return result
+
+
+def load_strokes(data_dir, datasets, limit=1000, num_workers=8,
+                 use_processes=False):
+  """Loads the raw strokes and class labels of every split.
+
+  Classes are loaded in parallel on a thread or process pool and gathered
+  once into preallocated arrays, so the work stays linear in the number of
+  classes. Also merges the moments of the training x and y offsets, clamped
+  to limit like DataLoader does, across classes.
+  """
+  start = time.time()
+  if use_processes:
+    pool = futures.ProcessPoolExecutor(num_workers)
+  else:
+    pool = futures.ThreadPoolExecutor(num_workers)
+  with pool:
+    pending = {pool.submit(load_class, data_dir, dataset, limit): idx
+               for idx, dataset in enumerate(datasets)}
+    classes = [None] * len(datasets)
+    for count, future in enumerate(futures.as_completed(pending)):
+      idx = pending[future]
+      data = classes[idx] = future.result()
+      tf.logging.info('Loaded {}/{}/{} from {} in {:.2f}s ({}/{})'.format(
+          len(data['train']), len(data['valid']), len(data['test']),
+          datasets[idx], data['time'], count + 1, len(datasets)))
+
+  splits = []
+  for split in ('train', 'valid', 'test'):
+    sizes = [len(data[split]) for data in classes]
+    strokes = np.empty(sum(sizes), dtype=object)
+    labels = np.empty(sum(sizes), dtype=np.int32)
+    begin = 0
+    for idx, data in enumerate(classes):
+      strokes[begin:begin + sizes[idx]] = data[split]
+      labels[begin:begin + sizes[idx]] = idx
+      begin += sizes[idx]
+    splits.append((strokes, labels))
+  (train_strokes, train_y), (valid_strokes, valid_y), (
+      test_strokes, test_y) = splits
+
+  train_moments = utils.RunningMoments()
+  for data in classes:
+    train_moments.merge(data['moments'])
+  num_sketches = len(train_strokes) + len(valid_strokes) + len(test_strokes)
+  avg_len = sum(data['num_points'] for data in classes) / num_sketches
+  tf.logging.info('Dataset combined: {} ({}/{}/{}), avg len {}, {:.2f}s'.format(
+      num_sketches, len(train_strokes), len(valid_strokes),
+      len(test_strokes), int(avg_len), time.time() - start))
+
+  # calculate the max strokes we need.
+  max_seq_len = max(data['max_len'] for data in classes)
+  return (train_strokes, valid_strokes, test_strokes, train_y, valid_y,
+          test_y, max_seq_len, train_moments)
+
+def softmax_cross_entropy(logits, labels):
+  """Per example softmax cross entropy, the loss of Model.lossfunctions."""
+  shifted = logits - np.max(logits, axis=1, keepdims=True)
+  log_norm = np.log(np.sum(np.exp(shifted), axis=1))
+  return log_norm - shifted[np.arange(len(labels)), labels]
+
+
 def evaluate_model(sess, model, data_set):
-  """Returns the average weighted cost, reconstruction cost and KL cost."""
+  """Returns the average cost, the logits, accuracy and confusion matrix.
+
+  Every sketch of data_set is scored exactly once, the final partial batch
+  included. Logits are written into a preallocated array while cost and
+  confusion counts are accumulated batch by batch.
+  """
+  num_sketches = len(data_set.strokes)
+  num_classes = model.hps.num_classes
+  pred_arr = np.empty((num_sketches, num_classes), dtype=np.float32)
+  confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
   total_cost = 0.0
-  pred_arr = None
-  for batch in range(data_set.num_batches):
-    unused_orig_x, lab_v, x, s = data_set.get_batch(batch)
-    # print (x)
+  for batch in range(data_set.num_eval_batches):
+    (unused_orig_x, lab_v, x, s), num_valid = data_set.get_eval_batch(batch)
     feed = {model.input_data: x, model.y_labels: lab_v, model.sequence_lengths: s}
-    (cost,pred) = sess.run([model.cost, model.output], feed)
-    if pred_arr is None:
-      pred_arr = np.array(pred)
-    else:
-      pred_arr = np.concatenate((pred_arr, pred))
-    total_cost += cost
+    pred = sess.run(model.output, feed)
+    lab_v = np.asarray(lab_v)
+    start = batch * data_set.batch_size
+    pred_arr[start:start + num_valid] = pred
+    total_cost += np.sum(softmax_cross_entropy(pred, lab_v))
+    confusion += np.bincount(
+        lab_v * num_classes + np.argmax(pred, axis=1),
+        minlength=num_classes * num_classes).reshape(num_classes, num_classes)
 
-  total_cost /= (data_set.num_batches)
-  return total_cost, pred_arr
+  total_cost /= max(num_sketches, 1)
+  accuracy = np.trace(confusion) / max(num_sketches, 1)
+  return total_cost, pred_arr, accuracy, confusion
 
 
 def load_checkpoint(sess, checkpoint_path):
@@ -208,12 +375,109 @@ def load_checkpoint(sess, checkpoint_path):
   saver.restore(sess, ckpt.model_checkpoint_path)
 
 
-def save_model(sess, model_save_path, global_step):
-  saver = tf.train.Saver(tf.global_variables())
-  checkpoint_path = os.path.join(model_save_path, 'vector')
-  tf.logging.info('saving model %s.', checkpoint_path)
-  tf.logging.info('global_step %i.', global_step)
-  saver.save(sess, checkpoint_path, global_step=global_step)
+def load_model_params(checkpoint_path, inference=False):
+  """Load the hparams a model in checkpoint_path was trained with.
+
+  With inference=True, dropout is turned off and the training ops are left
+  out of the graph the hparams describe.
+  """
+  model_params = sketch_rnn_model.get_default_hparams()
+  with tf.gfile.Open(os.path.join(checkpoint_path, 'model_config.json')) as f:
+    model_params.parse_json(f.read())
+  if inference:
+    model_params.use_input_dropout = 0
+    model_params.use_recurrent_dropout = 0
+    model_params.use_output_dropout = 0
+    model_params.is_training = 0
+  return model_params
+
+
+def load_normalization(checkpoint_path):
+  """Return the (scale_factor, limit) the training data was normalized with."""
+  with tf.gfile.Open(os.path.join(checkpoint_path, 'normalization.json')) as f:
+    normalization = json.load(f)
+  return normalization['scale_factor'], normalization['limit']
+
+
+SAMPLER_STATE_FILE = 'sampler_state.json'
+
+
+def sampler_state(samplers, start_states, num_batches, global_step):
+  """Return the sampler positions to store with a checkpoint.
+
+  The samplers themselves may have drawn ahead to fill the prefetch queues,
+  so the positions are taken from start_states, the states when training
+  started, moved on by the num_batches batches each sampler has trained on.
+  global_step is the step of the checkpoint, which load_sampler_state
+  checks the positions against.
+  """
+  return {'step': int(global_step),
+          'samplers': [sampler.advance_state(state, num_batches)
+                       for sampler, state in zip(samplers, start_states)]}
+
+
+def load_sampler_state(samplers, checkpoint_path, global_step=None):
+  """Resume the training samplers if saved positions exist.
+
+  Positions saved for another step than global_step, the step of the
+  restored checkpoint, are not used.
+  """
+  state_path = os.path.join(checkpoint_path, SAMPLER_STATE_FILE)
+  if not tf.gfile.Exists(state_path):
+    return
+  with tf.gfile.Open(state_path, 'r') as f:
+    states = json.load(f)
+  if isinstance(states, dict) and 'samplers' in states:
+    if global_step is not None and states['step'] != global_step:
+      tf.logging.warning('Sampler positions are from step %i, the checkpoint '
+                         'from step %i, not resuming the samplers.',
+                         states['step'], global_step)
+      return
+    states = states['samplers']
+  elif isinstance(states, dict):
+    states = [states]
+  if len(states) != len(samplers):
+    tf.logging.warning('Saved %i sampler states for %i samplers, not '
+                       'resuming the samplers.', len(states), len(samplers))
+    return
+  for sampler, state in zip(samplers, states):
+    sampler.set_state(state)
+    tf.logging.info('Resuming sampler at epoch %i, batch %i.',
+                    sampler.epoch, sampler.position)
+
+
+def session_config(num_replicas=1):
+  """Return a session config with one CPU device per model replica."""
+  return tf.ConfigProto(device_count={'CPU': num_replicas},
+                        allow_soft_placement=True)
+
+
+def batch_dataset(next_batch, buffer_size=2):
+  """Return a tf.data.Dataset of (x, sequence_lengths, labels) batches.
+
+  Batches come from next_batch, e.g. DataLoader.random_batch, and buffer_size
+  of them are built ahead of the training step.
+  """
+  def generator():
+    while True:
+      _, labels, x, seq_len = next_batch()
+      # x is a view of a reused pad buffer, and the graph may still hold
+      # earlier batches (prefetched, or not yet read by a multi-step run)
+      # when the buffer comes round again.
+      yield x.copy(), seq_len, labels
+
+  dataset = tf.data.Dataset.from_generator(
+      generator, (tf.float32, tf.int32, tf.int32),
+      (tf.TensorShape([None, None, 5]), tf.TensorShape([None]),
+       tf.TensorShape([None])))
+  return dataset.prefetch(buffer_size)
+
+
+def crosses_multiple(step, num_steps, every):
+  """Whether steps step .. step + num_steps - 1 include a positive multiple."""
+  first = max(step, 1)
+  last = step + num_steps - 1
+  return last >= first and last // every > (first - 1) // every
 
 
 def train(sess, model, eval_model, train_set, valid_set, test_set):
@@ -242,64 +506,134 @@ def train(sess, model, eval_model, train_set, valid_set, test_set):
   # main train loop
 
   hps = model.hps
-  start = time.time()
-
-  for _ in range(hps.num_steps):
-
-    step = sess.run(model.global_step)
-
-    curr_learning_rate = ((hps.learning_rate - hps.min_learning_rate) *
-                          (hps.decay_rate)**step + hps.min_learning_rate)
-    
-    _, lab, x, s = train_set.random_batch()
-    feed = {
-        model.input_data: x,
-        model.y_labels: lab,
-        model.sequence_lengths: s,
-        model.lr: curr_learning_rate,
-    }
+  checkpoints = checkpoint_manager.CheckpointManager(
+      sess, FLAGS.log_root, keep_last=FLAGS.keep_last_checkpoints,
+      keep_best=FLAGS.keep_best_checkpoints)
+  # every data parallel replica trains on its own shard of train_set.
+  if FLAGS.num_replicas > 1:
+    shards = [train_set.shard(i, FLAGS.num_replicas)
+              for i in range(FLAGS.num_replicas)]
+  else:
+    shards = [train_set]
+  samplers = [shard.sampler for shard in shards]
+  profiler = profiling.Profiler(
+      enabled=FLAGS.profile, window=FLAGS.profile_window,
+      trace_steps=profiling.parse_trace_steps(FLAGS.trace_steps),
+      trace_dir=FLAGS.log_root)
+  if profiler.enabled:
+    for shard in shards:
+      shard.profiler = profiler
+  # global_step is only read once, then counted along with the runs.
+  step = sess.run(model.global_step)
+  if FLAGS.resume_training:
+    load_sampler_state(samplers, FLAGS.log_root, step)
+  first_step = step
+  start_states = [sampler.get_state() for sampler in samplers]
+  if FLAGS.prefetch_batches > 0:
+    prefetchers = [
+        prefetch.BatchPrefetcher(
+            shard, queue_size=FLAGS.prefetch_batches,
+            num_workers=FLAGS.prefetch_workers,
+            use_processes=FLAGS.prefetch_processes) for shard in shards]
+    next_batches = [prefetcher.next_batch for prefetcher in prefetchers]
+  else:
+    prefetchers = []
+    next_batches = [shard.random_batch for shard in shards]
+  if FLAGS.in_graph_steps > 0:
+    steps_per_run = FLAGS.in_graph_steps
+    iterator = batch_dataset(next_batches[0]).make_initializable_iterator()
+    train_op, cost_op, lr_op = sketch_rnn_model.multi_step_train_op(
+        model, iterator.get_next, steps_per_run)
+    sess.run(iterator.initializer)
+    replicas = []
+    feed = None
+  elif FLAGS.num_replicas > 1:
+    steps_per_run = 1
+    replicas, train_op, cost_op, lr_op = (
+        sketch_rnn_model.data_parallel_train_op(model, FLAGS.num_replicas))
+  else:
+    steps_per_run = 1
+    replicas = [model]
+    train_op, cost_op, lr_op = model.train_op, model.cost, model.lr_update
 
-    (train_cost, _, train_step, _) = sess.run([
-        model.cost, model.output,
-        model.global_step, model.train_op
-    ], feed)
+  start = time.time()
 
-    if step % 20 == 0 and step > 0:
+  for _ in range(0, hps.num_steps, steps_per_run):
+
+    if replicas:
+      feed = {}
+      for replica, next_batch in zip(replicas, next_batches):
+        with profiler.phase('batch'):
+          _, lab, x, s = next_batch()
+        with profiler.phase('feed'):
+          feed.update({
+              replica.input_data: x,
+              replica.y_labels: lab,
+              replica.sequence_lengths: s,
+          })
+
+    options, run_metadata = profiler.trace_options(step, steps_per_run)
+    with profiler.phase('step'):
+      (train_cost, curr_learning_rate, _) = sess.run(
+          [cost_op, lr_op, train_op], feed, options=options,
+          run_metadata=run_metadata)
+    profiler.write_trace(step, run_metadata, summary_writer)
+    train_step = step + steps_per_run
+
+    if crosses_multiple(step, steps_per_run, 20):
       # Logging stuff here
       end = time.time()
       time_taken = end - start
       time_taken_list.append(time_taken)
 
-      cost_summ = tf.summary.Summary()
-      cost_summ.value.add(tag='Train_Cost', simple_value=float(train_cost))
-      cost_list.append(float(train_cost))
-      lr_summ = tf.summary.Summary()
-      lr_summ.value.add(
-          tag='Learning_Rate', simple_value=float(curr_learning_rate))
+      with profiler.phase('summaries'):
+        cost_summ = tf.summary.Summary()
+        cost_summ.value.add(tag='Train_Cost', simple_value=float(train_cost))
+        cost_list.append(float(train_cost))
+        lr_summ = tf.summary.Summary()
+        lr_summ.value.add(
+            tag='Learning_Rate', simple_value=float(curr_learning_rate))
       
-      time_summ = tf.summary.Summary()
-      time_summ.value.add(
-          tag='Time_Taken_Train', simple_value=float(time_taken))
-
-      output_format = ('step: %d, lr: %.6f, cost: %f, train_time_taken: %.4f')
-      output_values = (step, curr_learning_rate, train_cost, time_taken)
-      output_log = output_format % output_values
+        time_summ = tf.summary.Summary()
+        time_summ.value.add(
+            tag='Time_Taken_Train', simple_value=float(time_taken))
+
+        output_format = ('step: %d, epoch: %d, lr: %.6f, cost: %f, '
+                         'train_time_taken: %.4f')
+        output_values = (step, samplers[0].epoch, curr_learning_rate,
+                         train_cost, time_taken)
+        output_log = output_format % output_values
 
-      tf.logging.info(output_log)
+        tf.logging.info(output_log)
 
-      summary_writer.add_summary(cost_summ, train_step)
-      summary_writer.add_summary(lr_summ, train_step)
-      summary_writer.add_summary(time_summ, train_step)
-      summary_writer.flush()
+        if prefetchers:
+          stats = [prefetcher.pop_stats() for prefetcher in prefetchers]
+          queue_depth = np.mean([depth for depth, _ in stats])
+          stall_time = np.sum([stall for _, stall in stats])
+          tf.logging.info('prefetch_queue_depth: %.2f, prefetch_stall: %.4f',
+                          queue_depth, stall_time)
+          prefetch_summ = tf.summary.Summary()
+          prefetch_summ.value.add(
+              tag='Prefetch_Queue_Depth', simple_value=float(queue_depth))
+          prefetch_summ.value.add(
+              tag='Prefetch_Stall_Time', simple_value=float(stall_time))
+          summary_writer.add_summary(prefetch_summ, train_step)
+
+        summary_writer.add_summary(cost_summ, train_step)
+        summary_writer.add_summary(lr_summ, train_step)
+        summary_writer.add_summary(time_summ, train_step)
+        if profiler.enabled:
+          profiler.log_means()
+          summary_writer.add_summary(profiler.summary(), train_step)
+        summary_writer.flush()
       start = time.time()
 
-    if step % hps.save_every == 0 and step > 0:
+    if crosses_multiple(step, steps_per_run, hps.save_every):
+
+      with profiler.phase('eval'):
+        valid_cost, _, valid_accuracy, _ = evaluate_model(
+            sess, eval_model, valid_set)
 
-      valid_cost, pred_v = evaluate_model(sess, eval_model, valid_set)
-      pred_v = np.array(pred_v)
-      pred_class = np.argmax(pred_v, axis=1)
-      print (np.sum(pred_class==valid_set.labels))
-      
       end = time.time()
       time_taken_valid = end - start
       start = time.time()
@@ -307,13 +641,17 @@ def train(sess, model, eval_model, train_set, valid_set, test_set):
       valid_cost_summ = tf.summary.Summary()
       valid_cost_summ.value.add(
           tag='Valid_Cost', simple_value=float(valid_cost))
+      valid_cost_summ.value.add(
+          tag='Valid_Accuracy', simple_value=float(valid_accuracy))
       
       valid_time_summ = tf.summary.Summary()
       valid_time_summ.value.add(
           tag='Time_Taken_Valid', simple_value=float(time_taken_valid))
 
-      output_format = ('best_valid_cost: %0.4f, valid_cost: %.4f, valid_time_taken: %.4f')
-      output_values = (min(best_valid_cost, valid_cost), valid_cost, time_taken_valid)
+      output_format = ('best_valid_cost: %0.4f, valid_cost: %.4f, '
+                       'valid_accuracy: %.4f, valid_time_taken: %.4f')
+      output_values = (min(best_valid_cost, valid_cost), valid_cost,
+                       valid_accuracy, time_taken_valid)
       output_log = output_format % output_values
 
       tf.logging.info(output_log)
@@ -322,16 +660,20 @@ def train(sess, model, eval_model, train_set, valid_set, test_set):
       summary_writer.add_summary(valid_time_summ, train_step)
       summary_writer.flush()
 
-      if valid_cost < best_valid_cost:
-        best_valid_cost = valid_cost
-
-        save_model(sess, FLAGS.log_root, step)
+      # only the variable snapshot blocks, the write happens in background,
+      # along with the positions of the batches trained on so far.
+      with profiler.phase('checkpoint'):
+        time_taken_save = checkpoints.save(
+            step, valid_cost, json_files={
+                SAMPLER_STATE_FILE: sampler_state(
+                    samplers, start_states, train_step - first_step,
+                    train_step)})
+      start = time.time()
 
-        end = time.time()
-        time_taken_save = end - start
-        start = time.time()
+      tf.logging.info('time_taken_save %4.4f.', time_taken_save)
 
-        tf.logging.info('time_taken_save %4.4f.', time_taken_save)
+      if valid_cost < best_valid_cost:
+        best_valid_cost = valid_cost
 
         best_valid_cost_summ = tf.summary.Summary()
         best_valid_cost_summ.value.add(
@@ -340,13 +682,15 @@ def train(sess, model, eval_model, train_set, valid_set, test_set):
         summary_writer.add_summary(best_valid_cost_summ, train_step)
         summary_writer.flush()
 
-        eval_cost, pred_v = evaluate_model(sess, eval_model, test_set)
-        pred_v = np.array(pred_v)
-        pred_class = np.argmax(pred_v, axis=1)
-        accuracy_val = np.sum(pred_class==test_set.labels)*100/len(test_set.labels)
+        with profiler.phase('eval'):
+          eval_cost, _, accuracy_val, confusion = evaluate_model(
+              sess, eval_model, test_set)
+        accuracy_val *= 100
         print ("==================================================")
         print ("=          Accuracy = ", accuracy_val, "         =")
         print ("==================================================")
+        tf.logging.info('test confusion (rows: label, columns: prediction):'
+                        '\n%s', confusion)
         accuracy_list.append(accuracy_val)
         end = time.time()
         time_taken_eval = end - start
@@ -368,16 +712,28 @@ def train(sess, model, eval_model, train_set, valid_set, test_set):
         summary_writer.add_summary(eval_time_summ, train_step)
         summary_writer.flush()
 
+    step = train_step
+
+  for prefetcher in prefetchers:
+    prefetcher.close()
+  checkpoints.close()
+  tf.logging.info('checkpointing blocked training for %4.4fs in total.',
+                  checkpoints.blocked_time)
+
 def trainer(model_params):
   """Train a sketch-rnn model."""
   np.set_printoptions(precision=8, edgeitems=6, linewidth=200, suppress=True)
 
   tf.logging.info('sketch-rnn')
   tf.logging.info('Hyperparams:')
-  for key, val in model_params.values().iteritems():
+  for key, val in model_params.values().items():
     tf.logging.info('%s = %s', key, str(val))
   tf.logging.info('Loading data files.')
-  datasets = load_dataset(FLAGS.data_dir, model_params)
+  datasets = load_dataset(FLAGS.data_dir, model_params,
+                          cache_dir=FLAGS.dataset_cache_dir,
+                          num_workers=FLAGS.load_workers,
+                          use_processes=FLAGS.load_processes,
+                          download_dir=FLAGS.download_cache_dir)
 
   train_set = datasets[0]
   valid_set = datasets[1]
@@ -385,11 +741,18 @@ def trainer(model_params):
   model_params = datasets[3]
   eval_model_params = datasets[4]
 
-  reset_graph()
-  model = sketch_rnn_model.Model(model_params)
-  eval_model = sketch_rnn_model.Model(eval_model_params, reuse=True)
+  if FLAGS.num_replicas > 1 and FLAGS.in_graph_steps > 0:
+    raise ValueError('--num_replicas and --in_graph_steps can not be combined.')
 
-  sess = tf.InteractiveSession()
+  reset_graph()
+  # the in-graph steps need variables read anew by every step, see
+  # multi_step_train_op; checkpoints are the same either way.
+  with tf.variable_scope(tf.get_variable_scope(),
+                         use_resource=FLAGS.in_graph_steps > 0 or None):
+    model = sketch_rnn_model.Model(model_params)
+    eval_model = sketch_rnn_model.Model(eval_model_params, reuse=True)
+
+  sess = tf.InteractiveSession(config=session_config(FLAGS.num_replicas))
   sess.run(tf.global_variables_initializer())
 
   if FLAGS.resume_training:
@@ -400,6 +763,11 @@ def trainer(model_params):
   with tf.gfile.Open(
       os.path.join(FLAGS.log_root, 'model_config.json'), 'w') as f:
     json.dump(model_params.values(), f, indent=True)
+  # Record the data normalization so the model can be served on raw sketches.
+  with tf.gfile.Open(
+      os.path.join(FLAGS.log_root, 'normalization.json'), 'w') as f:
+    json.dump({'scale_factor': float(train_set.scale_factor),
+               'limit': train_set.limit}, f, indent=True)
 
   train(sess, model, eval_model, train_set, valid_set, test_set)
 
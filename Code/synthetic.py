@@ -0,0 +1,70 @@
+"""Synthetic QuickDraw-like data for benchmarks and load tests.
+
+Sketches are stroke-3 arrays of int16 (dx, dy, pen_lift) rows like the
+sketch-rnn .npz files, with log-normally distributed lengths (median about
+55 points, clipped to [min_len, max_len]) split into strokes of about a
+dozen points. Bitmaps are flattened 28x28 uint8 images like the QuickDraw
+numpy_bitmap .npy files. Only numpy is needed, so nothing is downloaded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+
+def sketch_lengths(rng, num_sketches, min_len=10, max_len=250,
+                   median=55.0, sigma=0.45):
+  """Return num_sketches log-normally distributed sketch lengths."""
+  lengths = rng.lognormal(np.log(median), sigma, size=num_sketches)
+  return np.clip(np.round(lengths), min_len, max_len).astype(np.int64)
+
+
+def random_sketch(rng, min_len=10, max_len=120, length=None):
+  """Return a random stroke-3 sketch made of short pen-down strokes."""
+  if length is None:
+    length = rng.randint(min_len, max_len + 1)
+  sketch = np.zeros((length, 3), dtype=np.int16)
+  sketch[:, 0:2] = rng.randint(-30, 31, size=(length, 2))
+  sketch[:, 2] = rng.rand(length) < 1.0 / 12
+  sketch[-1, 2] = 1
+  return sketch
+
+
+def random_sketches(rng, num_sketches, min_len=10, max_len=250):
+  """Return an object array of num_sketches realistic length sketches."""
+  sketches = np.empty(num_sketches, dtype=object)
+  for i, length in enumerate(sketch_lengths(rng, num_sketches, min_len,
+                                            max_len)):
+    sketches[i] = random_sketch(rng, length=length)
+  return sketches
+
+
+def random_bitmaps(rng, num_images, image_size=28, num_segments=6):
+  """Return [num_images, image_size**2] uint8 images of random line art."""
+  images = np.zeros((num_images, image_size, image_size), dtype=np.uint8)
+  steps = np.linspace(0.0, 1.0, 2 * image_size)
+  ends = rng.randint(0, image_size, size=(num_images, num_segments, 2, 2))
+  # every segment is drawn as 2 * image_size points between its two ends.
+  start, end = ends[:, :, 0, None, :], ends[:, :, 1, None, :]
+  points = np.round(start + (end - start) * steps[:, None]).astype(np.int64)
+  image = np.repeat(np.arange(num_images), num_segments * len(steps))
+  images[image, points[..., 1].ravel(), points[..., 0].ravel()] = 255
+  return images.reshape(num_images, image_size * image_size)
+
+
+def write_npz_dataset(data_dir, rng, num_classes=10, num_train=2500,
+                      num_valid=250, num_test=250):
+  """Write sketchrnn_synthetic_<i>.npz class files, return their names."""
+  names = []
+  for i in range(num_classes):
+    name = 'sketchrnn_synthetic_%d.npz' % i
+    np.savez(os.path.join(data_dir, name),
+             train=random_sketches(rng, num_train),
+             valid=random_sketches(rng, num_valid),
+             test=random_sketches(rng, num_test))
+    names.append(name)
+  return names
@@ -19,6 +19,9 @@ from __future__ import print_function
 import random
 import numpy as np
 
+# only imports TensorFlow when exporting, so this module stays numpy only.
+import profiling
+
 def augment_strokes(strokes, prob=0.0):
   """Perform data augmentation by randomly dropping out strokes."""
   # drop each point within a line segments with a probability of prob
@@ -43,6 +46,328 @@ def augment_strokes(strokes, prob=0.0):
       result.append(stroke)
   return np.array(result)
 
+def augment_strokes_batch(points, lengths, prob=0.0):
+  """Vectorized augment_strokes over a whole batch of sketches.
+
+  Applies the same point dropping rule as augment_strokes: a point is only
+  eligible once it is at least the fourth consecutive pen-down point after a
+  pen lift, and a dropped point's offsets are merged into the last kept point.
+
+  Args:
+    points: array of shape [sum(lengths), 3], the stroke-3 sketches of the
+      batch stored back to back.
+    lengths: int array holding the number of points of each sketch.
+    prob: probability of dropping each eligible point.
+
+  Returns:
+    A (points, lengths) pair for the augmented batch in the same layout.
+  """
+  lengths = np.asarray(lengths, dtype=np.int64)
+  num_points = len(points)
+  if prob <= 0 or num_points == 0:
+    return points, lengths
+  starts = np.cumsum(lengths) - lengths
+  pen = points[:, 2]
+  # pen state of the previous point, with a pen lift before every sketch.
+  prev_pen = np.empty(num_points, dtype=pen.dtype)
+  prev_pen[1:] = pen[:-1]
+  prev_pen[starts[lengths > 0]] = 1
+  # count is the distance to the last point that reset the run.
+  reset = (pen == 1) | (prev_pen == 1)
+  position = np.arange(num_points)
+  last_reset = np.maximum.accumulate(np.where(reset, position, 0))
+  count = position - last_reset
+  keep = (count <= 2) | (np.random.rand(num_points) >= prob)
+  kept = np.flatnonzero(keep)
+  result = np.add.reduceat(points, kept, axis=0)
+  result[:, 2] = pen[kept]
+  sketch_id = np.repeat(np.arange(len(lengths)), lengths)
+  new_lengths = np.bincount(sketch_id[kept], minlength=len(lengths))
+  return result, new_lengths
+
+def stroke_3_to_5(points, lengths, max_len, out=None,
+                  start_stroke_token=(0, 0, 1, 0, 0)):
+  """Convert a batch of stroke-3 sketches to padded stroke-5 in one pass.
+
+  The start token S_0 is written at step 0 and each sketch is written at an
+  offset of one step, so no per-sketch shifting copy is needed.
+
+  Args:
+    points: array of shape [sum(lengths), 3], the stroke-3 sketches of the
+      batch stored back to back.
+    lengths: int array holding the number of points of each sketch.
+    max_len: pad every sketch to max_len + 1 steps (start token included).
+    out: optional float32 array of shape [len(lengths), max_len + 1, 5] to
+      write into, e.g. one handed out by a Stroke5Buffer.
+    start_stroke_token: the S_0 token put at the start of every sketch.
+
+  Returns:
+    The stroke-5 batch, which is out when it was given.
+  """
+  lengths = np.asarray(lengths, dtype=np.int64)
+  batch_size = len(lengths)
+  if out is None:
+    out = np.empty((batch_size, max_len + 1, 5), dtype=np.float32)
+  assert batch_size == 0 or lengths.max() <= max_len
+  out.fill(0)
+  sketch_id = np.repeat(np.arange(batch_size), lengths)
+  starts = np.cumsum(lengths) - lengths
+  step = np.arange(len(points)) - np.repeat(starts, lengths) + 1
+  out[sketch_id, step, 0:2] = points[:, 0:2]
+  out[sketch_id, step, 3] = points[:, 2]
+  out[sketch_id, step, 2] = 1 - points[:, 2]
+  # every step past the end of a sketch is an end-of-sketch token.
+  np.greater(np.arange(max_len + 1), lengths[:, None], out=out[:, :, 4])
+  out[:, 0, :] = start_stroke_token  # setting S_0 from paper.
+  return out
+
+
+class Stroke5Buffer(object):
+  """Preallocated float32 storage reused across stroke-5 batches.
+
+  get() hands out the buffers in rotation, so a batch stays valid until
+  num_buffers more batches have been requested. With num_buffers=2 the next
+  batch can be filled while the current one is still being fed.
+  """
+
+  def __init__(self, batch_size, max_len, num_buffers=2):
+    size = batch_size * (max_len + 1) * 5
+    self._buffers = [np.empty(size, dtype=np.float32)
+                     for _ in range(num_buffers)]
+    self._next = 0
+
+  def get(self, batch_size, max_len):
+    """Return the next buffer viewed as a [batch_size, max_len + 1, 5] array."""
+    size = batch_size * (max_len + 1) * 5
+    if size > len(self._buffers[self._next]):
+      self._buffers[self._next] = np.empty(size, dtype=np.float32)
+    buf = self._buffers[self._next]
+    self._next = (self._next + 1) % len(self._buffers)
+    # a prefix of the flat storage keeps the returned batch contiguous.
+    return buf[:size].reshape(batch_size, max_len + 1, 5)
+
+
+def clamp_and_scale(points, limit, scale_factor):
+  """Clamp stroke-3 points to +-limit and divide x and y by scale_factor.
+
+  This is the normalization a DataLoader applies to its sketches; the points
+  are modified in place and returned.
+  """
+  np.clip(points, -limit, limit, out=points)
+  points[:, 0:2] /= scale_factor
+  return points
+
+
+def normalize_and_pad(sketches, scale_factor, limit=1000):
+  """Turn raw stroke-3 sketches into a normalized stroke-5 model input.
+
+  Returns:
+    The stroke-5 batch, padded to its longest sketch, and the sketch lengths.
+  """
+  lengths = np.array([len(sketch) for sketch in sketches], dtype=np.int64)
+  points = np.concatenate(sketches).astype(np.float32)
+  clamp_and_scale(points, limit, scale_factor)
+  return stroke_3_to_5(points, lengths, int(lengths.max())), lengths
+
+
+def ragged_index(starts, lengths):
+  """Return the flat positions of the rows [start, start + length) in order."""
+  batch_starts = np.cumsum(lengths) - lengths
+  return np.repeat(starts - batch_starts, lengths) + np.arange(np.sum(lengths))
+
+
+class RaggedStrokes(object):
+  """Sequence view of sketches stored as one point array plus offsets.
+
+  Sketch i is points[offsets[i]:offsets[i + 1]]; indexing returns a view, so
+  code written against a list of ndarrays keeps working on the flat layout.
+  """
+
+  def __init__(self, points, offsets):
+    self.points = points
+    self.offsets = offsets
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if i < 0 or i >= len(self):
+      raise IndexError('sketch index out of range')
+    return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.points[self.offsets[i]:self.offsets[i + 1]]
+
+  def lengths(self):
+    """Return the number of points of every sketch."""
+    return np.diff(self.offsets)
+
+
+class EpochSampler(object):
+  """Hands out batches of sketch indices, shuffling once per epoch.
+
+  At the start of each epoch the indices of every length bucket are shuffled
+  and cut into batches, and the order of those batches is shuffled, so each
+  call to next_batch only slices out batch_size indices. Sketches left over
+  after cutting a bucket into full batches sit that epoch out. The shuffle
+  only depends on (seed, epoch), which makes get_state/set_state enough to
+  resume at the exact same position.
+
+  With replacement=True every batch is instead drawn independently, like
+  the old random_batch: batch_size distinct sketches from a bucket picked in
+  proportion to its size.
+  """
+
+  def __init__(self, bucket_offsets, batch_size, replacement=False, seed=None):
+    """Initializer for the sampler.
+
+    Args:
+      bucket_offsets: bucket b spans indices [offsets[b], offsets[b + 1]).
+      batch_size: number of indices per batch.
+      replacement: if True, sample every batch independently.
+      seed: integer seed for the shuffles, picked at random when None.
+    """
+    self.bucket_offsets = np.asarray(bucket_offsets, dtype=np.int64)
+    self.bucket_sizes = np.diff(self.bucket_offsets)
+    self.batch_size = batch_size
+    self.replacement = replacement
+    if seed is None:
+      seed = np.random.randint(2**31 - 1)
+    self.seed = int(seed)
+    self.num_batches = int(np.sum(
+        np.maximum(self.bucket_sizes // batch_size,
+                   np.minimum(self.bucket_sizes, 1))))
+    self._start_epoch(0)
+
+  def _start_epoch(self, epoch):
+    """Reshuffle for the given epoch and rewind to its first batch."""
+    self.epoch = epoch
+    self.position = 0
+    self._rng = np.random.RandomState([self.seed, epoch])
+    if self.replacement:
+      return
+    batches = []
+    buckets = []
+    for bucket, size in enumerate(self.bucket_sizes):
+      perm = self.bucket_offsets[bucket] + self._rng.permutation(size)
+      num_full = size // self.batch_size
+      if num_full == 0 and size > 0:
+        # a bucket smaller than a batch is handed out whole.
+        batches.append(perm)
+      else:
+        batches.extend(perm[:num_full * self.batch_size].reshape(
+            num_full, self.batch_size))
+      buckets.extend([bucket] * max(num_full, min(size, 1)))
+    order = self._rng.permutation(len(batches))
+    self._batches = [batches[i] for i in order]
+    self._buckets = [buckets[i] for i in order]
+
+  def _sample_batch(self):
+    """Draw batch_size distinct indices from a randomly chosen bucket."""
+    bucket = self._rng.choice(
+        len(self.bucket_sizes),
+        p=self.bucket_sizes / float(np.sum(self.bucket_sizes)))
+    size = self.bucket_sizes[bucket]
+    if size <= self.batch_size:
+      idx = self._rng.permutation(size)
+    else:
+      # rejection keeps this O(batch_size) instead of permuting the bucket.
+      idx = np.unique(self._rng.randint(0, size, self.batch_size))
+      while len(idx) < self.batch_size:
+        idx = np.unique(np.concatenate(
+            (idx, self._rng.randint(0, size, self.batch_size - len(idx)))))
+    return self.bucket_offsets[bucket] + idx, bucket
+
+  def next_batch(self):
+    """Return the next (indices, bucket) pair, moving to a new epoch if due."""
+    if self.position >= self.num_batches:
+      self._start_epoch(self.epoch + 1)
+    if self.replacement:
+      batch = self._sample_batch()
+    else:
+      batch = self._batches[self.position], self._buckets[self.position]
+    self.position += 1
+    return batch
+
+  def get_state(self):
+    """Return a JSON-serializable snapshot of the sampler position."""
+    return {'seed': self.seed, 'epoch': self.epoch, 'position': self.position,
+            'replacement': self.replacement}
+
+  def advance_state(self, state, num_batches):
+    """Return state moved on by num_batches draws, without drawing them.
+
+    Lets a consumer record the position of the batches it actually used
+    while prefetching draws ahead of it.
+    """
+    state = dict(state)
+    total = int(state['position']) + num_batches
+    if total > 0:
+      epochs = (total - 1) // self.num_batches
+      state['epoch'] = int(state['epoch']) + epochs
+      state['position'] = total - epochs * self.num_batches
+    return state
+
+  def set_state(self, state):
+    """Resume from a snapshot taken with get_state."""
+    self.seed = int(state['seed'])
+    self.replacement = bool(state['replacement'])
+    self._start_epoch(int(state['epoch']))
+    if self.replacement:
+      # replay the draws made so far so the random stream lines up.
+      for _ in range(int(state['position'])):
+        self._sample_batch()
+    self.position = int(state['position'])
+
+
+class RunningMoments(object):
+  """Streaming, mergeable mean and variance of a stream of values.
+
+  Each chunk is reduced on its own and folded in with the parallel update
+  of Chan et al., which stays numerically stable without keeping the values
+  around. Accumulators built over different classes or workers can be
+  combined with merge.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0  # sum of squared deviations from the mean
+
+  def _combine(self, count, mean, m2):
+    total = self.count + count
+    if total == 0:
+      return
+    delta = mean - self.mean
+    self.mean += delta * count / total
+    self.m2 += m2 + delta * delta * self.count * count / total
+    self.count = total
+
+  def update(self, values):
+    """Fold a chunk of values (any shape) into the running moments."""
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if len(values):
+      mean = np.mean(values)
+      self._combine(len(values), mean, np.sum(np.square(values - mean)))
+    return self
+
+  def merge(self, other):
+    """Fold in the moments accumulated by another RunningMoments."""
+    self._combine(other.count, other.mean, other.m2)
+    return self
+
+  def variance(self):
+    """Return the population variance of everything seen so far."""
+    return self.m2 / self.count if self.count else 0.0
+
+  def std(self):
+    """Return the population standard deviation, like np.std."""
+    return np.sqrt(self.variance())
+
+
 def get_max_len(strokes):
   """Return the maximum length of an array of strokes."""
   max_len = 0
@@ -63,7 +388,11 @@ class DataLoader(object):
                scale_factor=1.0,
                random_scale_factor=0.0,
                augment_stroke_prob=0.0,
-               limit=1000):
+               limit=1000,
+               num_pad_buffers=0,
+               num_buckets=1,
+               sample_with_replacement=False,
+               shuffle_seed=None):
     self.labels = labels
     
     self.batch_size = batch_size  # minibatch size
@@ -75,37 +404,114 @@ class DataLoader(object):
     self.limit = limit
     self.augment_stroke_prob = augment_stroke_prob  # data augmentation method
     self.start_stroke_token = [0, 0, 1, 0, 0]  # S_0 in sketch-rnn paper
-    # sets self.strokes (list of ndarrays, one per sketch, in stroke-3 format,
-    # sorted by size)
+    # number of reusable stroke-5 buffers to rotate through; 0 allocates a
+    # new array per batch, 2 double buffers.
+    self.num_pad_buffers = num_pad_buffers
+    self._pad_buffer = None
+    # number of length buckets; batches are drawn from one bucket and padded
+    # to that bucket's longest sketch instead of max_seq_length.
+    self.num_buckets = num_buckets
+    # random_batch draws from an EpochSampler built on the buckets.
+    self.sample_with_replacement = sample_with_replacement
+    self.shuffle_seed = shuffle_seed
+    # optional profiling.Profiler timing the augment and pad phases.
+    self.profiler = None
+    # sets self.points, self.offsets and self.labels (sketches in stroke-3
+    # format stored back to back, sorted by size) and self.strokes, a
+    # sequence view over them.
     self.preprocess(strokes)
 
   def preprocess(self, strokes):
-    """Remove entries from strokes having > max_seq_length points."""
-    raw_data = []
-    seq_len = []
-    count_data = 0
-    new_labels = []
-    for i in range(len(strokes)):
-      data = strokes[i]
-      if len(data) <= (self.max_seq_length):
-        count_data += 1
-        # removes large gaps from the data
-        data = np.minimum(data, self.limit)
-        data = np.maximum(data, -self.limit)
-        data = np.array(data, dtype=np.float32)
-        data[:, 0:2] /= self.scale_factor
-        raw_data.append(data)
-        seq_len.append(len(data))
-        new_labels.append(self.labels[i])
-    seq_len = np.array(seq_len)  # nstrokes for each sketch
-    idx = np.argsort(seq_len)
-    self.strokes = []
-    self.labels = []
-    for i in range(len(seq_len)):
-      self.strokes.append(raw_data[idx[i]])
-      self.labels.append(new_labels[idx[i]])
+    """Remove entries from strokes having > max_seq_length points.
+
+    strokes may also be a RaggedStrokes holding sketches that an earlier
+    DataLoader already preprocessed (e.g. mapped in from the dataset cache),
+    in which case the arrays are used as they are, without copying.
+    """
+    if isinstance(strokes, RaggedStrokes):
+      self.points = strokes.points
+      self.offsets = strokes.offsets
+      self.labels = np.asarray(self.labels)
+      self.strokes = strokes
+      count_data = len(strokes)
+      print("total images <= max_seq_len is %d" % count_data)
+      self.num_batches = int(count_data / self.batch_size)
+      self.num_eval_batches = -(-count_data // self.batch_size)
+      self.make_buckets(self.num_buckets)
+      return
+    lengths = np.array([len(data) for data in strokes], dtype=np.int64)
+    keep = np.flatnonzero(lengths <= self.max_seq_length)
+    order = keep[np.argsort(lengths[keep], kind='stable')]
+    count_data = len(order)
+    self.offsets = np.zeros(count_data + 1, dtype=np.int64)
+    np.cumsum(lengths[order], out=self.offsets[1:])
+    self.points = np.empty((self.offsets[-1], 3), dtype=np.float32)
+    for i in range(count_data):
+      self.points[self.offsets[i]:self.offsets[i + 1]] = strokes[order[i]]
+    # removes large gaps from the data
+    clamp_and_scale(self.points, self.limit, self.scale_factor)
+    self.labels = np.asarray(self.labels, dtype=np.int32)[order]
+    self.strokes = RaggedStrokes(self.points, self.offsets)
     print("total images <= max_seq_len is %d" % count_data)
     self.num_batches = int(count_data / self.batch_size)
+    # includes the final partial batch, see get_eval_batch.
+    self.num_eval_batches = -(-count_data // self.batch_size)
+    self.make_buckets(self.num_buckets)
+
+  def make_buckets(self, num_buckets):
+    """Split the length-sorted sketches into equally sized length buckets.
+
+    Bucket b holds the sketches in [bucket_offsets[b], bucket_offsets[b + 1])
+    and batches drawn from it are padded to bucket_lengths[b]. Every bucket
+    holds at least one full batch, so fewer buckets than asked for may be
+    made on small datasets.
+    """
+    num_sketches = len(self.offsets) - 1
+    num_buckets = max(1, min(num_buckets, num_sketches // self.batch_size))
+    self.num_buckets = num_buckets
+    self.bucket_offsets = np.linspace(
+        0, num_sketches, num_buckets + 1).astype(np.int64)
+    if num_buckets == 1:
+      self.bucket_lengths = np.array([self.max_seq_length], dtype=np.int64)
+    else:
+      # sketches are sorted, so the last one of a bucket is its longest.
+      last = self.bucket_offsets[1:] - 1
+      self.bucket_lengths = self.offsets[last + 1] - self.offsets[last]
+    self.sampler = EpochSampler(
+        self.bucket_offsets, self.batch_size,
+        replacement=self.sample_with_replacement, seed=self.shuffle_seed)
+
+  def shard(self, index, num_shards):
+    """Return a DataLoader over every num_shards-th sketch, from index on.
+
+    Taking a stride through the length-sorted sketches keeps the length
+    distribution of every shard close to the full set's. The shard gets its
+    own copy of the points and its own sampler, offset by index when
+    shuffle_seed is set, so data parallel replicas draw different batches.
+    """
+    keep = np.arange(index, len(self.offsets) - 1, num_shards)
+    lengths = self.offsets[keep + 1] - self.offsets[keep]
+    offsets = np.zeros(len(keep) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    points = self.points[ragged_index(self.offsets[keep], lengths)]
+    seed = None if self.shuffle_seed is None else self.shuffle_seed + index
+    return DataLoader(
+        RaggedStrokes(points, offsets), self.labels[keep],
+        batch_size=self.batch_size,
+        max_seq_length=self.max_seq_length,
+        scale_factor=self.scale_factor,
+        random_scale_factor=self.random_scale_factor,
+        augment_stroke_prob=self.augment_stroke_prob,
+        limit=self.limit,
+        num_pad_buffers=self.num_pad_buffers,
+        num_buckets=self.num_buckets,
+        sample_with_replacement=self.sample_with_replacement,
+        shuffle_seed=seed)
+
+  def bucket_max_len(self, idx):
+    """Return the padded length used for the bucket holding sketch idx."""
+    bucket = np.searchsorted(self.bucket_offsets, idx, side='right') - 1
+    return int(self.bucket_lengths[min(bucket, self.num_buckets - 1)])
 
   def random_scale(self, data):
     """Augment data by stretching x and y axis randomly [1-e, 1+e]."""
@@ -118,49 +524,67 @@ class DataLoader(object):
     result[:, 1] *= y_scale_factor
     return result
 
+  def random_scale_batch(self, points, lengths):
+    """Apply random_scale to a whole batch of concatenated sketches in place."""
+    scale_factors = (
+        np.random.random((len(lengths), 2)) - 0.5) * 2 * (
+            self.random_scale_factor) + 1.0
+    points[:, 0:2] *= np.repeat(scale_factors, lengths, axis=0)
+    return points
+
   def calculate_normalizing_scale_factor(self):
     """Calculate the normalizing factor explained in appendix of sketch-rnn."""
-    data = []
-    for i in range(len(self.strokes)):
-      if len(self.strokes[i]) > self.max_seq_length:
-        continue
-      for j in range(len(self.strokes[i])):
-        data.append(self.strokes[i][j, 0])
-        data.append(self.strokes[i][j, 1])
-    data = np.array(data)
-    return np.std(data)
+    # preprocess already dropped sketches longer than max_seq_length.
+    moments = RunningMoments()
+    chunk_size = 1 << 20
+    for start in range(0, len(self.points), chunk_size):
+      moments.update(self.points[start:start + chunk_size, 0:2])
+    return moments.std()
 
   def normalize(self, scale_factor=None):
     """Normalize entire dataset (delta_x, delta_y) by the scaling factor."""
     if scale_factor is None:
       scale_factor = self.calculate_normalizing_scale_factor()
     self.scale_factor = scale_factor
-    for i in range(len(self.strokes)):
-      self.strokes[i][:, 0:2] /= self.scale_factor
+    self.points[:, 0:2] /= self.scale_factor
 
-  def _get_batch_from_indices(self, indices):
+  def _get_batch_from_indices(self, indices, max_len=None, out=None):
     """Given a list of indices, return the potentially augmented batch."""
-    x_batch = []
-    seq_len = []
-    x_labels = []
-    for idx in range(len(indices)):
-      i = indices[idx]
-      data = self.random_scale(self.strokes[i])
-      data_copy = np.copy(data)
+    if max_len is None:
+      max_len = self.max_seq_length
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = self.offsets[indices]
+    lengths = self.offsets[indices + 1] - starts
+    # the gather copies the sketches, so augmentation never touches the data.
+    points = self.points[ragged_index(starts, lengths)]
+    with self._phase('augment'):
+      self.random_scale_batch(points, lengths)
       if self.augment_stroke_prob > 0:
-        data_copy = augment_strokes(data_copy, self.augment_stroke_prob)
-      x_batch.append(data_copy)
-      length = len(data_copy)
-      seq_len.append(length)
-      x_labels.append(self.labels[i])
-    seq_len = np.array(seq_len, dtype=int)
+        points, lengths = augment_strokes_batch(
+            points, lengths, self.augment_stroke_prob)
+    x_batch = np.split(points, np.cumsum(lengths)[:-1])
+    x_labels = self.labels[indices]
+    seq_len = np.array(lengths, dtype=int)
     # We return three things: stroke-3 format, stroke-5 format, list of seq_len.
-    return x_batch, x_labels, self.pad_batch(x_batch, self.max_seq_length), seq_len
+    with self._phase('pad'):
+      stroke_5 = self._pad_points(points, lengths, max_len, out=out)
+    return x_batch, x_labels, stroke_5, seq_len
+
+  def _phase(self, name):
+    """Return a timer for phase name, a no-op one without a profiler."""
+    if self.profiler is None:
+      return profiling.NULL_PHASE
+    return self.profiler.phase(name)
 
   def random_batch(self):
     """Return a randomised portion of the training data."""
-    idx = np.random.permutation(range(0, len(self.strokes)))[0:self.batch_size]
-    return self._get_batch_from_indices(idx)
+    idx, max_len = self.random_indices()
+    return self._get_batch_from_indices(idx, max_len)
+
+  def random_indices(self):
+    """Draw the sketch indices and padded length of the next random batch."""
+    idx, bucket = self.sampler.next_batch()
+    return idx, self.bucket_lengths[bucket]
 
   def get_batch(self, idx):
     """Get the idx'th batch from the dataset."""
@@ -168,23 +592,36 @@ class DataLoader(object):
     assert idx < self.num_batches, "idx must be less than the number of batches"
     start_idx = idx * self.batch_size
     indices = range(start_idx, start_idx + self.batch_size)
-    return self._get_batch_from_indices(indices)
+    return self._get_batch_from_indices(
+        indices, self.bucket_max_len(indices[-1]))
+
+  def get_eval_batch(self, idx):
+    """Get the idx'th batch, including the final partial one.
+
+    Returns:
+      The get_batch tuple and the number of sketches in it, which is less
+      than batch_size for the final batch.
+    """
+    assert idx >= 0, "idx must be non negative"
+    assert idx < self.num_eval_batches, "idx must be less than the number of batches"
+    start_idx = idx * self.batch_size
+    end_idx = min(start_idx + self.batch_size, len(self.strokes))
+    indices = range(start_idx, end_idx)
+    batch = self._get_batch_from_indices(indices, self.bucket_max_len(end_idx - 1))
+    return batch, end_idx - start_idx
 
   def pad_batch(self, batch, max_len):
     """Pad the batch to be stroke-5 bigger format as described in paper."""
-    result = np.zeros((self.batch_size, max_len + 1, 5), dtype=float)
     assert len(batch) == self.batch_size
-    for i in range(self.batch_size):
-      l = len(batch[i])
-      assert l <= max_len
-      result[i, 0:l, 0:2] = batch[i][:, 0:2]
-      result[i, 0:l, 3] = batch[i][:, 2]
-      result[i, 0:l, 2] = 1 - result[i, 0:l, 3]
-      result[i, l:, 4] = 1
-      # put in the first token, as described in sketch-rnn methodology
-      result[i, 1:, :] = result[i, :-1, :]
-      result[i, 0, :] = 0
-      result[i, 0, 2] = self.start_stroke_token[2]  # setting S_0 from paper.
-      result[i, 0, 3] = self.start_stroke_token[3]
-      result[i, 0, 4] = self.start_stroke_token[4]
-    return result
+    lengths = np.array([len(data) for data in batch], dtype=int)
+    return self._pad_points(np.concatenate(batch), lengths, max_len)
+
+  def _pad_points(self, points, lengths, max_len, out=None):
+    """Convert concatenated stroke-3 points to stroke-5, reusing buffers."""
+    if out is None and self.num_pad_buffers > 0:
+      if self._pad_buffer is None:
+        self._pad_buffer = Stroke5Buffer(
+            self.batch_size, max_len, self.num_pad_buffers)
+      out = self._pad_buffer.get(len(lengths), max_len)
+    return stroke_3_to_5(points, lengths, max_len, out=out,
+                         start_stroke_token=self.start_stroke_token)